@@ -1,25 +1,23 @@
 from fastapi import APIRouter, Depends
 from app.schemas.image import HealthResponse
 from app.services.illustration_service import IllustrationService
+from app.dependencies import get_illustration_service
 
 router = APIRouter()
 
 
-def get_illustration_service() -> IllustrationService:
-    """Dependency to get illustration service instance"""
-    return IllustrationService()
-
-
 @router.get("/", response_model=HealthResponse)
-async def health_check(service: IllustrationService = Depends(get_illustration_service)):
+async def health_check(service: IllustrationService = Depends(get_illustration_service, use_cache=True)):
     """Health check endpoint"""
     if service.is_ready():
         return HealthResponse(
             status="healthy",
-            message="Illustration generation service is ready"
+            message="Illustration generation service is ready",
+            queue_depth=service.batcher.queue_depth
         )
     else:
         return HealthResponse(
             status="unhealthy",
-            message="Illustration generation service is not ready"
+            message="Illustration generation service is not ready",
+            queue_depth=service.batcher.queue_depth
         )
@@ -1,40 +1,149 @@
+import asyncio
+import json
+from contextlib import ExitStack
 from fastapi import APIRouter, HTTPException, Depends
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from app.schemas.image import (
-    GenerateIllustrationInput, 
     GenerateMemoryIllustrationInput,
+    GenerateMemoryIllustrationsInput,
     GenerateSubjectIllustrationInput,
-    ImageResponse,
     S3ImageResponse,
     TrainLoRAInput,
     TrainLoRAResponse,
-    TrainingStatusResponse
+    TrainingStatusResponse,
+    GenerationJobResponse,
+    GenerationJobStatusResponse
 )
 from app.services.illustration_service import IllustrationService
 from app.services.subject_customization_service import SubjectCustomizationService
-from app.middleware.auth import get_auth_dependency
-
-router = APIRouter()
-
+from app.dependencies import (
+    get_illustration_service,
+    get_subject_customization_service,
+    json_body,
+    json_body_openapi
+)
+from app.middleware.auth import auth_dependencies
+from app.core.batcher import QueueFullError
+from app.core.config import settings
 
-def get_illustration_service() -> IllustrationService:
-    """Dependency to get illustration service instance"""
-    return IllustrationService()
+router = APIRouter(dependencies=auth_dependencies)
 
 
-def get_subject_customization_service() -> SubjectCustomizationService:
-    """Dependency to get subject customization service instance"""
-    return SubjectCustomizationService()
+def queue_full_exception(error: QueueFullError) -> HTTPException:
+    """429 response telling the client when to retry"""
+    return HTTPException(
+        status_code=429,
+        detail=str(error),
+        headers={"Retry-After": str(settings.queue_retry_after_seconds)}
+    )
 
 
-@router.post("/memory", response_model=S3ImageResponse)
+@router.post(
+    "/memory",
+    response_model=S3ImageResponse,
+    openapi_extra=json_body_openapi(GenerateMemoryIllustrationInput)
+)
 async def generate_memory_illustration(
-    memory_input: GenerateMemoryIllustrationInput,
-    service: IllustrationService = Depends(get_illustration_service),
-    _: bool = Depends(get_auth_dependency)
+    memory_input: GenerateMemoryIllustrationInput = Depends(json_body(GenerateMemoryIllustrationInput)),
+    service: IllustrationService = Depends(get_illustration_service, use_cache=True)
 ):
     """Generate a memory illustration using user's avatar as IP-Adapter input"""
     try:
-        return await service.generate_memory_illustration(
+        with service.batcher.admit():
+            return await service.generate_memory_illustration(
+                memory_input.user_id,
+                memory_input.prompt,
+                memory_input.num_inference_steps,
+                memory_input.ip_adapter_scale,
+                memory_input.negative_prompt,
+                memory_input.style_prompt,
+                memory_input.lora_id
+            )
+    except QueueFullError as e:
+        raise queue_full_exception(e)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post(
+    "/memory/batch",
+    response_model=S3ImageResponse,
+    openapi_extra=json_body_openapi(GenerateMemoryIllustrationsInput)
+)
+async def generate_memory_illustrations(
+    memory_input: GenerateMemoryIllustrationsInput = Depends(json_body(GenerateMemoryIllustrationsInput)),
+    service: IllustrationService = Depends(get_illustration_service, use_cache=True)
+):
+    """Generate memory illustrations for several prompts, batched together"""
+    if not memory_input.prompts:
+        raise HTTPException(status_code=400, detail="prompts must not be empty")
+    if len(memory_input.prompts) > settings.max_queue_depth:
+        # Such a batch could never be admitted, however long the client retries
+        raise HTTPException(
+            status_code=413,
+            detail=f"at most {settings.max_queue_depth} prompts per batch"
+        )
+    try:
+        with ExitStack() as admission:
+            # One queue slot per prompt
+            for _ in memory_input.prompts:
+                admission.enter_context(service.batcher.admit())
+            return await service.generate_memory_illustrations(
+                memory_input.user_id,
+                memory_input.prompts,
+                memory_input.num_inference_steps,
+                memory_input.ip_adapter_scale,
+                memory_input.negative_prompt,
+                memory_input.style_prompt,
+                memory_input.lora_id
+            )
+    except QueueFullError as e:
+        raise queue_full_exception(e)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post(
+    "/subject",
+    response_model=S3ImageResponse,
+    openapi_extra=json_body_openapi(GenerateSubjectIllustrationInput)
+)
+async def generate_subject_illustration(
+    subject_input: GenerateSubjectIllustrationInput = Depends(json_body(GenerateSubjectIllustrationInput)),
+    service: IllustrationService = Depends(get_illustration_service, use_cache=True)
+):
+    """Generate a subject illustration using user's uploaded photo and special prompt"""
+    try:
+        with service.batcher.admit():
+            return await service.generate_subject_illustration(
+                subject_input.user_id,
+                subject_input.num_inference_steps,
+                subject_input.ip_adapter_scale,
+                subject_input.negative_prompt,
+                subject_input.style_prompt,
+                subject_input.lora_id
+            )
+    except QueueFullError as e:
+        raise queue_full_exception(e)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post(
+    "/memory/job",
+    response_model=GenerationJobResponse,
+    status_code=202,
+    openapi_extra=json_body_openapi(GenerateMemoryIllustrationInput)
+)
+async def start_memory_illustration_job(
+    memory_input: GenerateMemoryIllustrationInput = Depends(json_body(GenerateMemoryIllustrationInput)),
+    service: IllustrationService = Depends(get_illustration_service, use_cache=True)
+):
+    """Queue a memory illustration. Returns immediately with job_id."""
+    try:
+        job_id = service.start_generation_job(
+            service.generate_memory_illustration,
             memory_input.user_id,
             memory_input.prompt,
             memory_input.num_inference_steps,
@@ -43,19 +152,27 @@ async def generate_memory_illustration(
             memory_input.style_prompt,
             memory_input.lora_id
         )
+        return GenerationJobResponse(job_id=job_id, status="queued")
+    except QueueFullError as e:
+        raise queue_full_exception(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@router.post("/subject", response_model=S3ImageResponse)
-async def generate_subject_illustration(
-    subject_input: GenerateSubjectIllustrationInput,
-    service: IllustrationService = Depends(get_illustration_service),
-    _ = Depends(get_auth_dependency)
+@router.post(
+    "/subject/job",
+    response_model=GenerationJobResponse,
+    status_code=202,
+    openapi_extra=json_body_openapi(GenerateSubjectIllustrationInput)
+)
+async def start_subject_illustration_job(
+    subject_input: GenerateSubjectIllustrationInput = Depends(json_body(GenerateSubjectIllustrationInput)),
+    service: IllustrationService = Depends(get_illustration_service, use_cache=True)
 ):
-    """Generate a subject illustration using user's uploaded photo and special prompt"""
+    """Queue a subject illustration. Returns immediately with job_id."""
     try:
-        return await service.generate_subject_illustration(
+        job_id = service.start_generation_job(
+            service.generate_subject_illustration,
             subject_input.user_id,
             subject_input.num_inference_steps,
             subject_input.ip_adapter_scale,
@@ -63,19 +180,64 @@ async def generate_subject_illustration(
             subject_input.style_prompt,
             subject_input.lora_id
         )
+        return GenerationJobResponse(job_id=job_id, status="queued")
+    except QueueFullError as e:
+        raise queue_full_exception(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@router.post("/train-lora", response_model=TrainLoRAResponse)
+@router.get("/job/{job_id}", response_model=GenerationJobStatusResponse)
+async def get_generation_job_status(
+    job_id: str,
+    service: IllustrationService = Depends(get_illustration_service, use_cache=True)
+):
+    """Get the status of a generation job"""
+    status = service.get_job_status(job_id)
+    if not status:
+        raise HTTPException(status_code=404, detail="Generation job not found")
+    return GenerationJobStatusResponse(job_id=job_id, **status)
+
+
+@router.get("/job/{job_id}/events")
+async def stream_generation_job_events(
+    job_id: str,
+    service: IllustrationService = Depends(get_illustration_service, use_cache=True)
+):
+    """Stream generation job status as server-sent events until it finishes"""
+    if not service.get_job_status(job_id):
+        raise HTTPException(status_code=404, detail="Generation job not found")
+
+    async def events():
+        last_status = None
+        while True:
+            status = service.get_job_status(job_id)
+            if status is None:
+                return
+            if status != last_status:
+                last_status = status
+                yield "data: {}\n\n".format(json.dumps(dict(status, job_id=job_id)))
+            if status["status"] in ("completed", "failed"):
+                return
+            await asyncio.sleep(0.25)
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@router.post(
+    "/train-lora",
+    response_model=TrainLoRAResponse,
+    openapi_extra=json_body_openapi(TrainLoRAInput)
+)
 async def train_lora(
-    train_input: TrainLoRAInput,
-    service: SubjectCustomizationService = Depends(get_subject_customization_service),
-    _: bool = Depends(get_auth_dependency)
+    train_input: TrainLoRAInput = Depends(json_body(TrainLoRAInput)),
+    service: SubjectCustomizationService = Depends(get_subject_customization_service, use_cache=True)
 ):
     """Start a LoRA training job asynchronously. Returns immediately with job_id."""
     try:
-        job_id = service.start_training_job(
+        # Service calls are synchronous; keep them off the event loop
+        job_id = await run_in_threadpool(
+            service.start_training_job,
             user_id=train_input.user_id,
             training_images_s3_path=train_input.training_images_s3_path,
             lora_name=train_input.lora_name,
@@ -86,7 +248,7 @@ async def train_lora(
         )
         
         # Get initial status
-        status = service.get_training_status(job_id)
+        status = await run_in_threadpool(service.get_training_status, job_id)
         if not status:
             raise HTTPException(status_code=500, detail="Failed to create training job")
         
@@ -102,12 +264,11 @@ async def train_lora(
 @router.get("/train-lora/{job_id}", response_model=TrainingStatusResponse)
 async def get_training_status(
     job_id: str,
-    service: SubjectCustomizationService = Depends(get_subject_customization_service),
-    _: bool = Depends(get_auth_dependency)
+    service: SubjectCustomizationService = Depends(get_subject_customization_service, use_cache=True)
 ):
     """Get the status of a LoRA training job"""
     try:
-        status = service.get_training_status(job_id)
+        status = await run_in_threadpool(service.get_training_status, job_id)
         if not status:
             raise HTTPException(status_code=404, detail="Training job not found")
         
@@ -0,0 +1,155 @@
+import asyncio
+import logging
+from contextlib import contextmanager
+from typing import Any, Dict, List, Tuple
+from app.core.config import settings
+from app.core.pipeline import TextToImagePipeline, gpu_lock, inference_executor
+from app.utils.image_utils import batch_key, prepare_batch, run_batch
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """Raised when too many generation requests are already admitted"""
+
+
+class DiffusionBatcher:
+    """
+    Coalesces concurrent inference requests into batched pipeline calls.
+
+    Requests are queued and collected for up to batch_window_ms, then grouped
+    by batch_key so that only requests sharing steps, LoRA adapter and
+    IP-Adapter scale run together in a single pipeline call.
+    """
+    _instance = None
+    _initialized = False
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super(DiffusionBatcher, cls).__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if not self._initialized:
+            self.max_batch_size = max(1, settings.max_batch_size)
+            self.batch_window = settings.batch_window_ms / 1000
+            self._queue = None
+            self._worker = None
+            self._admitted = 0
+            self._initialized = True
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of generation requests currently admitted (waiting or running)"""
+        return self._admitted
+
+    @contextmanager
+    def admit(self):
+        """
+        Reserve a slot for one generation request for the duration of the block.
+
+        Raises:
+            QueueFullError: If max_queue_depth requests are already admitted
+        """
+        if self._admitted >= settings.max_queue_depth:
+            raise QueueFullError(
+                "Too many generation requests in progress ({}), try again later".format(self._admitted)
+            )
+        self._admitted += 1
+        try:
+            yield
+        finally:
+            self._admitted -= 1
+
+    def start(self):
+        """Start the batching loop on the running event loop (no-op if running)"""
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.get_running_loop().create_task(self._run())
+            logger.info("Started diffusion batcher (max_batch_size=%s, window=%sms)",
+                        self.max_batch_size, settings.batch_window_ms)
+
+    async def stop(self):
+        """Stop the batching loop"""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+    async def submit(self, request: Dict[str, Any]) -> Any:
+        """Queue an inference request and wait for its generated image"""
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((request, future))
+        return await future
+
+    async def _collect(self) -> List[Tuple[Dict[str, Any], asyncio.Future]]:
+        """Wait for one request, then gather whatever arrives within the window"""
+        items = [await self._queue.get()]
+        if self.max_batch_size > 1:
+            await asyncio.sleep(self.batch_window)
+        while len(items) < self.max_batch_size and not self._queue.empty():
+            items.append(self._queue.get_nowait())
+        return items
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        running = None  # Task executing the in-flight batch
+        while True:
+            items = await self._collect()
+
+            buckets: Dict[Tuple, List[Tuple[Dict[str, Any], asyncio.Future]]] = {}
+            for request, future in items:
+                buckets.setdefault(batch_key(request), []).append((request, future))
+
+            for bucket in buckets.values():
+                requests = [request for request, _ in bucket]
+                pipeline = TextToImagePipeline().pipeline
+                try:
+                    # Stage inputs while the previous batch is still generating
+                    pipeline_kwargs, ready_event = await loop.run_in_executor(
+                        None, prepare_batch, pipeline, requests
+                    )
+                except Exception as e:
+                    self._fail(bucket, e)
+                    continue
+
+                # Batches run one at a time so the GPU is never shared between calls
+                if running is not None:
+                    await running
+                running = loop.create_task(
+                    self._execute(bucket, pipeline, pipeline_kwargs, ready_event)
+                )
+
+    async def _execute(self, bucket: List[Tuple[Dict[str, Any], asyncio.Future]], pipeline,
+                       pipeline_kwargs: Dict[str, Any], ready_event: Any):
+        """Run one prepared batch and resolve its futures"""
+        requests = [request for request, _ in bucket]
+        logger.info("Running batch of %s inference request(s)", len(requests))
+        try:
+            images = await asyncio.get_running_loop().run_in_executor(
+                inference_executor, self._run_batch, pipeline, requests, pipeline_kwargs, ready_event
+            )
+        except Exception as e:
+            self._fail(bucket, e)
+        else:
+            for (_, future), image in zip(bucket, images):
+                if not future.done():
+                    future.set_result(image)
+
+    @staticmethod
+    def _run_batch(pipeline, requests: List[Dict[str, Any]], pipeline_kwargs: Dict[str, Any],
+                   ready_event: Any) -> List:
+        """Switch to the batch's LoRA adapter, then run it (on the inference thread)"""
+        with gpu_lock:
+            TextToImagePipeline().activate_lora(requests[0].get("lora_id"))
+            return run_batch(pipeline, requests, pipeline_kwargs, ready_event)
+
+    @staticmethod
+    def _fail(bucket: List[Tuple[Dict[str, Any], asyncio.Future]], error: Exception):
+        for _, future in bucket:
+            if not future.done():
+                future.set_exception(error)
@@ -1,5 +1,7 @@
-from pydantic_settings import BaseSettings
 import os
+import tempfile
+from functools import lru_cache
+from pydantic_settings import BaseSettings
 
 
 class Settings(BaseSettings):
@@ -11,6 +13,26 @@ class Settings(BaseSettings):
     model_s3_path: str = "s3://auto-bio-illustrations/models/checkpoint-1.safetensors" 
     model_path: str = "stabilityai/stable-diffusion-xl-base-1.0"
     
+    # Quantize UNet weights to int8 with torchao at startup
+    enable_quantization: bool = False
+    quantize_text_encoders: bool = True  # With enable_quantization, also int8 CLIP-L/OpenCLIP-G (~1 GB less)
+    
+    # Compile UNet/VAE with torch.compile at startup (slower startup, faster steps;
+    # loading LoRAs at runtime triggers recompilation)
+    enable_compile: bool = False
+    compile_mode: str = "reduce-overhead"  # Or "max-autotune" (much slower startup)
+    enable_cuda_graph: bool = True  # Replay compiled denoise steps as CUDA graphs; disable on GPUs where capture fails
+    
+    # PyTorch CUDA caching allocator settings (PYTORCH_CUDA_ALLOC_CONF). Expandable
+    # segments avoid fragmentation as batch sizes vary between pipeline calls
+    cuda_alloc_conf: str = "expandable_segments:True,garbage_collection_threshold:0.8"
+    
+    # Step caching: reuse UNet transformer block outputs on steps between full
+    # computations, either every N steps (interval > 1) or until the latents drift
+    # past a relative L1 threshold (> 0, takes precedence). Disables UNet compile
+    step_cache_interval: int = 1
+    step_cache_rel_l1_threshold: float = 0.0
+    
     # IP Adapter configuration
     enable_ip_adapter: bool = False
     ip_adapter: str = ""
@@ -19,19 +41,56 @@ class Settings(BaseSettings):
     ip_adapter_scale_subject: float = 1.0
     ip_adapter_scale_memory: float = 0.33
     ip_adapter_image: str = ""
+    reference_image_cache_size: int = 256  # Encoded avatar/subject images (IP-Adapter embeddings) kept in memory
     
     # LoRA configuration
     enable_lora: bool = False
     lora_weights: str = ""
     lora_weights_name: str = ""
+    max_loaded_loras: int = 8  # Least recently used LoRAs are unloaded beyond this
+    preload_lora_ids: str = ""  # Comma-separated LoRA ids loaded at startup (most used first)
+    
+    # Sampler: "dpm++" (DPM++ 2M Karras), "euler" or "default" (checkpoint's own)
+    scheduler: str = "dpm++"
     
     # Inference parameter defaults
-    default_num_inference_steps: int = 50
+    default_num_inference_steps: int = 20
     default_ip_adapter_scale: float = 0.33
     default_negative_prompt: str = "error, glitch, mistake"
     default_memory_style_prompt: str = "highest quality, monochrome, professional sketch, personal, nostalgic, clean"
     default_subject_style_prompt: str = "highest quality, professional sketch, monochrome"
     
+    # Reuse text-encoder outputs for repeated style and negative prompts
+    enable_prompt_embedding_cache: bool = True
+    prompt_embedding_cache_size: int = 64
+    
+    # Approximate latent cache: requests whose prompt is this cosine-similar to
+    # an earlier one (same reference and settings) resume from its intermediate
+    # latents, skipping up to latent_cache_max_skip of the schedule
+    enable_latent_cache: bool = False
+    latent_cache_size: int = 128
+    latent_cache_similarity: float = 0.9
+    latent_cache_max_skip: float = 0.5
+    
+    # Request batching configuration
+    max_batch_size: int = 4
+    batch_window_ms: int = 10
+    
+    # Admission control: requests beyond this depth get 429 + Retry-After
+    max_queue_depth: int = 32
+    queue_retry_after_seconds: int = 30
+    
+    # Finished async generation jobs kept for status polling
+    max_tracked_jobs: int = 1024
+    
+    # zlib level for generated PNGs (0-9); 1 encodes several times faster than
+    # Pillow's default 6 for slightly larger files
+    png_compress_level: int = 1
+    
+    # Threads for S3 transfers and image decoding, separate from inference.
+    # S3 calls block, so this bounds how many run at once across requests
+    io_workers: int = 16
+    
     # Authentication configuration
     auth_token: str = ""  
     auth_enabled: bool = True
@@ -44,6 +103,12 @@ class Settings(BaseSettings):
     uvicorn_port: int = 8000
     uvicorn_reload: bool = False
     uvicorn_log_level: str = "info"
+    uvicorn_loop: str = "uvloop"
+    uvicorn_http: str = "httptools"
+    # Each worker holds its own copy of the model and CUDA context; a single
+    # worker with the request batcher is usually the better choice on one GPU
+    uvicorn_workers: int = 1
+    worker_gpu_memory_gb: float = 16.0  # GPU memory needed per worker, caps uvicorn_workers
     
     # S3 configuration
     aws_access_key_id: str = ""
@@ -54,6 +119,22 @@ class Settings(BaseSettings):
     s3_subject_prefix: str = "subjects/"
     s3_generated_prefix: str = "generated/"
     s3_lora_prefix: str = "loras/"
+    s3_max_concurrency: int = 16  # Parallel ranged GETs for large downloads
+    s3_multipart_threshold: int = 8 * 1024 * 1024  # Objects above this are fetched in parallel parts
+    s3_multipart_chunksize: int = 64 * 1024 * 1024
+    s3_io_chunksize: int = 1024 * 1024  # Socket read size per part (boto3 default is 256 KiB)
+    s3_max_pool_connections: int = 64  # Kept-alive connections shared by all S3 calls
+    s3_connect_timeout: int = 3
+    s3_read_timeout: int = 30
+    # "auto" hands large transfers to the AWS CRT (native multipart + TLS) on
+    # instance types it is optimized for; "classic" always uses s3transfer
+    s3_transfer_client: str = "auto"
+    
+    # Local cache for downloaded models and LoRAs (keyed by S3 ETag)
+    # Defaults under the temp dir so non-root runs can write it; point it at
+    # persistent storage to keep downloads across restarts
+    cache_dir: str = os.path.join(tempfile.gettempdir(), "illustration-gen-cache")
+    cache_revalidate_seconds: float = 60.0  # Trust a cached object's ETag this long before HEADing S3 again
     
     model_config = {
         "env_file": ".env",
@@ -62,4 +143,10 @@ class Settings(BaseSettings):
     }
 
 
-settings = Settings()
\ No newline at end of file
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """Return the process-wide settings, parsing .env only once"""
+    return Settings()
+
+
+settings = get_settings()
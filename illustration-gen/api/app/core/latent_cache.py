@@ -0,0 +1,200 @@
+import itertools
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+import torch
+from diffusers import StableDiffusionXLImg2ImgPipeline
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Fractions of the schedule at which intermediate latents are kept
+SNAPSHOT_FRACTIONS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9)
+
+
+def _prompt_embeddings(pipeline, prompts: List[str]) -> torch.Tensor:
+    """Normalized CLIP-L pooled embeddings of the prompts, on the CPU"""
+    input_ids = pipeline.tokenizer(
+        prompts,
+        padding="max_length",
+        max_length=pipeline.tokenizer.model_max_length,
+        truncation=True,
+        return_tensors="pt",
+    ).input_ids
+    with torch.inference_mode():
+        pooled = pipeline.text_encoder(input_ids.to(pipeline.text_encoder.device))[1]
+    return torch.nn.functional.normalize(pooled.float(), dim=-1).cpu()
+
+
+def _bucket(request: Dict[str, Any]) -> Tuple:
+    """Everything besides the prompt and reference that shapes the trajectory"""
+    return (
+        request["num_inference_steps"],
+        request["adapter_name"],
+        request["ip_adapter_scale"],
+        request["negative_prompt"],
+        request["style_prompt"],
+    )
+
+
+# Reference of a request whose latents must never be cached or reused
+UNCACHEABLE = object()
+
+
+def _reference_key(request: Dict[str, Any]) -> Any:
+    """
+    What identifies the request's IP-Adapter reference across requests:
+    None, the URL, or the image embeddings. PIL images have no stable
+    identity once they are gone, so they are UNCACHEABLE.
+    """
+    reference = request["reference_image"]
+    if reference is None or isinstance(reference, str):
+        return reference
+    if isinstance(reference, tuple):
+        return reference[0]
+    return UNCACHEABLE
+
+
+def _same_reference(a: Any, b: Any) -> bool:
+    if isinstance(a, torch.Tensor) and isinstance(b, torch.Tensor):
+        return a.shape == b.shape and torch.equal(a, b)
+    if isinstance(a, torch.Tensor) or isinstance(b, torch.Tensor):
+        return False
+    # None or URLs: different URLs never match
+    return a == b
+
+
+def snapshot_steps(scheduler) -> Dict[int, float]:
+    """
+    Map step counts to the snapshot fraction resumed from after them.
+
+    Matches StableDiffusionXLImg2ImgPipeline's denoising_start cutoff, which
+    is in timestep space rather than step count.
+    """
+    num_train_timesteps = scheduler.config.num_train_timesteps
+    timesteps = scheduler.timesteps.cpu()
+    steps = {}
+    for fraction in SNAPSHOT_FRACTIONS:
+        if fraction > settings.latent_cache_max_skip:
+            break
+        cutoff = int(round(num_train_timesteps - fraction * num_train_timesteps))
+        count = int((timesteps >= cutoff).sum())
+        if 0 < count < len(timesteps):
+            steps[count] = fraction
+    return steps
+
+
+class LatentCache:
+    """
+    Approximate cache of intermediate latents for near-duplicate prompts.
+
+    Full generations keep their latents at a few fractions of the schedule.
+    A later request whose prompt is cosine-similar (CLIP-L pooled embedding)
+    to a cached one, with the same reference image and settings, resumes from
+    one of those snapshots instead of from noise. Higher similarity skips more
+    of the schedule, up to latent_cache_max_skip.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries = OrderedDict()  # Map entry id -> (bucket, embedding, reference, snapshots)
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _skip_fraction(self, similarity: float) -> float:
+        threshold = settings.latent_cache_similarity
+        if similarity < threshold:
+            return 0.0
+        return settings.latent_cache_max_skip * (similarity - threshold) / max(1 - threshold, 1e-6)
+
+    def _match(self, request: Dict[str, Any], embedding: torch.Tensor) -> Tuple[float, Optional[Dict[float, torch.Tensor]]]:
+        """Best snapshot set for one request and the fraction it may skip"""
+        reference = _reference_key(request)
+        if reference is UNCACHEABLE:
+            return 0.0, None
+        bucket = _bucket(request)
+        best_similarity, best = 0.0, None
+        for entry_id, (entry_bucket, entry_embedding, entry_reference, snapshots) in self._entries.items():
+            if entry_bucket != bucket or not _same_reference(entry_reference, reference):
+                continue
+            similarity = float(entry_embedding @ embedding)
+            if similarity > best_similarity:
+                best_similarity, best = similarity, entry_id
+        if best is None:
+            return 0.0, None
+        self._entries.move_to_end(best)
+        return self._skip_fraction(best_similarity), self._entries[best][3]
+
+    def lookup(self, pipeline, requests: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Find cached latents for a batch of compatible requests.
+
+        The whole batch shares one schedule, so it resumes from the largest
+        snapshot fraction every request has, or starts from noise if any
+        request misses.
+
+        Returns:
+            Dict with the prompt embeddings (for store), denoising_start
+            (or None) and the batch's starting latents (or None)
+        """
+        embeddings = _prompt_embeddings(pipeline, [request["prompt"] for request in requests])
+        result = {"embeddings": embeddings, "denoising_start": None, "latents": None}
+
+        with self._lock:
+            matches = [self._match(request, embedding) for request, embedding in zip(requests, embeddings)]
+        if any(snapshots is None for _, snapshots in matches):
+            return result
+
+        max_fraction = min(fraction for fraction, _ in matches)
+        common = set.intersection(*(set(snapshots) for _, snapshots in matches))
+        fractions = [fraction for fraction in common if fraction <= max_fraction]
+        if not fractions:
+            return result
+
+        fraction = max(fractions)
+        result["denoising_start"] = fraction
+        result["latents"] = torch.cat([snapshots[fraction] for _, snapshots in matches])
+        logger.info("Resuming %s request(s) from cached latents at %s of the schedule", len(requests), fraction)
+        return result
+
+    def store(self, requests: List[Dict[str, Any]], embeddings: torch.Tensor,
+              snapshots: Dict[float, torch.Tensor]):
+        """Keep the snapshots ({fraction: [B, ...] CPU latents}) of a full generation"""
+        if not snapshots:
+            return
+        with self._lock:
+            for i, request in enumerate(requests):
+                reference = _reference_key(request)
+                if reference is UNCACHEABLE:
+                    continue
+                self._entries[next(self._ids)] = (
+                    _bucket(request),
+                    embeddings[i],
+                    reference,
+                    {fraction: latents[i:i + 1] for fraction, latents in snapshots.items()},
+                )
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+_resume_pipeline = None
+
+
+def get_resume_pipeline(pipeline) -> StableDiffusionXLImg2ImgPipeline:
+    """
+    Img2img view of the text-to-image pipeline (sharing all its components)
+    used to continue from cached latents via denoising_start.
+    """
+    global _resume_pipeline
+    if _resume_pipeline is None or _resume_pipeline.unet is not pipeline.unet:
+        _resume_pipeline = StableDiffusionXLImg2ImgPipeline.from_pipe(pipeline)
+    return _resume_pipeline
+
+
+# Global latent cache instance
+latent_cache = LatentCache(settings.latent_cache_size)
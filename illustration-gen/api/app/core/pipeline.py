@@ -1,13 +1,48 @@
 import torch
+import glob
 import logging
 import os
+import re
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
-from diffusers import AutoPipelineForText2Image, StableDiffusionXLPipeline
+from PIL import Image
+from diffusers import (
+    AutoPipelineForText2Image,
+    DPMSolverMultistepScheduler,
+    EulerDiscreteScheduler,
+    StableDiffusionXLPipeline,
+)
 from app.core.config import settings
+from app.core.prompt_embeddings import prompt_embedding_cache
+from app.core.step_cache import install_step_cache
 from app.utils.s3_utils import s3_client
 
 logger = logging.getLogger(__name__)
 
+# settings.scheduler -> (scheduler class, config overrides)
+SCHEDULERS = {
+    "dpm++": (DPMSolverMultistepScheduler, {"algorithm_type": "dpmsolver++", "use_karras_sigmas": True}),
+    "euler": (EulerDiscreteScheduler, {}),
+}
+
+
+# Held while a batch runs, and for a whole training run when training has to
+# share the inference GPU
+gpu_lock = threading.Lock()
+
+# CUDA graphs recorded by torch.compile belong to the thread that recorded
+# them, so startup warmup and every batch run on this one thread
+inference_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference")
+
+# Compile modes with the CUDA graph step replaced by its graph-free equivalent
+NO_CUDA_GRAPH_MODES = {
+    "reduce-overhead": "default",
+    "max-autotune": "max-autotune-no-cudagraphs",
+}
+
 
 class TextToImagePipeline:
     _instance = None
@@ -22,7 +57,13 @@ class TextToImagePipeline:
         if not self._initialized:
             self.pipeline = None
             self.device = None
-            self.loaded_loras = {}  # Map adapter_name -> lora_id
+            self.dtype = torch.bfloat16
+            self.loaded_loras = OrderedDict()  # Map adapter_name -> lora_id, least recently used first
+            self.base_adapters = []  # Adapters loaded at startup (settings.enable_lora), always active
+            self.active_adapter = None  # Dynamic adapter currently enabled on the pipeline
+            self._adapters_changed = False  # Set when loading may have changed the active adapters
+            self.step_cache = None  # StepCache when step caching is enabled
+            self.ready = False  # True once start() has fully loaded the pipeline
             self._initialized = True
 
     def start(self):
@@ -30,31 +71,38 @@ class TextToImagePipeline:
             logger.info("Loading CUDA")
             self.device = "cuda"
 
+            # Let any remaining fp32 matmuls/convs use TF32 tensor cores
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+            torch.set_float32_matmul_precision("high")
+
+            # bf16 needs Ampere or newer; older GPUs fall back to fp16 (diffusers
+            # upcasts the SDXL VAE where fp16 would overflow)
+            self.dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+            logger.info("Using %s weights", self.dtype)
+
             # Check for S3 model first, then local file, then default
             if settings.model_s3_path:
                 logger.info("Downloading model from S3")
                 model_path = s3_client.download_model_from_s3(settings.model_s3_path)
                 if not model_path:
                     raise Exception("Failed to download model from S3")
-                self.pipeline = StableDiffusionXLPipeline.from_single_file(
-                    model_path,
-                    torch_dtype=torch.float16,
-                ).to(device=self.device)
+                self.pipeline = self._load_single_file(model_path)
             elif settings.model_file:
                 logger.info("Loading model from local file")
-                self.pipeline = StableDiffusionXLPipeline.from_single_file(
-                    settings.model_file,
-                    torch_dtype=torch.float16,
-                ).to(device=self.device)
+                self.pipeline = self._load_single_file(settings.model_file)
             else:
                 logger.info("Loading default model from Hugging Face")
-                self.pipeline = AutoPipelineForText2Image.from_pretrained(
-                    settings.model_path,
-                    torch_dtype=torch.float16,
-                ).to(device=self.device)
+                self.pipeline = self._load_pretrained(AutoPipelineForText2Image, settings.model_path)
 
             # self.pipeline.enable_model_cpu_offload()
 
+            self._configure_scheduler()
+
+            # NHWC layout lets the conv-heavy UNet/VAE use tensor-core kernels
+            self.pipeline.unet.to(memory_format=torch.channels_last)
+            self.pipeline.vae.to(memory_format=torch.channels_last)
+
             # Load IP Adapter if enabled
             if settings.enable_ip_adapter:
                 self._load_ip_adapter()
@@ -62,6 +110,28 @@ class TextToImagePipeline:
             # Load LoRA weights if enabled
             if settings.enable_lora:
                 self._load_lora()
+                self.base_adapters = list(self.pipeline.get_active_adapters())
+
+            # Encode the default style and negative prompts once for all requests
+            prompt_embedding_cache.clear()
+            if settings.enable_prompt_embedding_cache:
+                prompt_embedding_cache.warm(self.pipeline, [
+                    settings.default_memory_style_prompt,
+                    settings.default_subject_style_prompt,
+                ], [settings.default_negative_prompt])
+
+            # Reuse transformer block outputs across adjacent denoising steps
+            self.step_cache = install_step_cache(self.pipeline)
+
+            # Quantize before compiling so the compiled graph uses int8 weights
+            if settings.enable_quantization:
+                self._quantize()
+
+            # Compile UNet/VAE after adapters are attached
+            if settings.enable_compile:
+                self._compile()
+
+            self.ready = True
 
         elif torch.backends.mps.is_available():
             logger.info("MPS device available, but not implemented")
@@ -69,6 +139,63 @@ class TextToImagePipeline:
         else:
             raise Exception("No CUDA or MPS device available")
 
+    def _load_pretrained(self, pipeline_class, path: str):
+        """Load a diffusers-format pipeline, reading weights straight onto the GPU"""
+        try:
+            return pipeline_class.from_pretrained(path, torch_dtype=self.dtype, device_map=self.device)
+        except (ValueError, NotImplementedError) as e:
+            logger.warning("Direct-to-GPU loading unavailable (%s), loading through CPU", e)
+            return pipeline_class.from_pretrained(path, torch_dtype=self.dtype).to(device=self.device)
+
+    def _load_single_file(self, model_path: str):
+        """
+        Load an original-format SDXL checkpoint.
+        
+        The first load converts it through from_single_file (CPU) and saves the
+        result in diffusers format next to the checkpoint. Later starts skip the
+        conversion and load each component's safetensors directly to the GPU.
+        The conversion is keyed by the checkpoint's size and mtime, so a file
+        replaced in place is converted again.
+        """
+        stat = os.stat(model_path)
+        base = os.path.splitext(model_path)[0]
+        converted_dir = "{}-{:x}-{:x}-diffusers".format(base, stat.st_size, stat.st_mtime_ns)
+        if os.path.isdir(converted_dir):
+            logger.info("Loading converted model from %s", converted_dir)
+            return self._load_pretrained(StableDiffusionXLPipeline, converted_dir)
+
+        pipeline = StableDiffusionXLPipeline.from_single_file(
+            model_path,
+            torch_dtype=self.dtype,
+        )
+
+        try:
+            logger.info("Saving converted model to %s", converted_dir)
+            temp_dir = converted_dir + ".part"
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            pipeline.save_pretrained(temp_dir, safe_serialization=True)
+            os.replace(temp_dir, converted_dir)
+            # Conversions of earlier versions of this checkpoint are stale now
+            for stale_dir in glob.glob(glob.escape(base) + "-*-diffusers"):
+                if stale_dir != converted_dir and re.fullmatch(r"-[0-9a-f]+-[0-9a-f]+-diffusers", stale_dir[len(base):]):
+                    shutil.rmtree(stale_dir, ignore_errors=True)
+        except Exception as e:
+            logger.warning("Could not save converted model: %s", e)
+
+        return pipeline.to(device=self.device)
+
+    def _configure_scheduler(self):
+        """Swap in the configured sampler ("default" keeps the checkpoint's scheduler)"""
+        if settings.scheduler == "default":
+            return
+        if settings.scheduler not in SCHEDULERS:
+            logger.warning("Unknown scheduler %s, keeping the checkpoint scheduler", settings.scheduler)
+            return
+
+        scheduler_class, overrides = SCHEDULERS[settings.scheduler]
+        logger.info("Using %s scheduler", settings.scheduler)
+        self.pipeline.scheduler = scheduler_class.from_config(self.pipeline.scheduler.config, **overrides)
+
     def _load_ip_adapter(self):
         """Load IP Adapter weights"""
         logger.info("Attaching IP-Adapter")
@@ -79,6 +206,54 @@ class TextToImagePipeline:
         )
         # self.pipeline.set_ip_adapter_scale(settings.ip_adapter_scale)
 
+    def _quantize(self):
+        """
+        Apply int8 weight-only quantization to the UNet and text encoders.
+
+        Weight-only int8 targets Linear layers, so the conv-heavy VAE stays in
+        bf16/fp16 where it would gain little.
+        """
+        try:
+            from torchao.quantization import quantize_, Int8WeightOnlyConfig
+        except ImportError:
+            logger.warning("torchao is not installed, skipping UNet quantization")
+            return
+
+        logger.info("Quantizing UNet weights to int8")
+        quantize_(self.pipeline.unet, Int8WeightOnlyConfig())
+        if settings.quantize_text_encoders:
+            logger.info("Quantizing text encoder weights to int8")
+            quantize_(self.pipeline.text_encoder, Int8WeightOnlyConfig())
+            quantize_(self.pipeline.text_encoder_2, Int8WeightOnlyConfig())
+
+    def _compile(self):
+        """Compile the UNet and VAE decoder with torch.compile and warm them up"""
+        mode = settings.compile_mode
+        if not settings.enable_cuda_graph:
+            mode = NO_CUDA_GRAPH_MODES.get(mode, mode)
+        logger.info("Compiling UNet and VAE decoder (mode=%s)", mode)
+        # Shapes only vary with batch size, so specialize instead of tracing
+        # dynamic shapes; each batch size gets its own captured denoise step
+        if self.step_cache is None:
+            self.pipeline.unet = torch.compile(self.pipeline.unet, mode=mode, dynamic=False)
+        else:
+            # The step cache branches in Python on every step, which would break
+            # the compiled (CUDA graph) UNet apart
+            logger.info("Step cache enabled, compiling the VAE decoder only")
+        self.pipeline.vae.decode = torch.compile(self.pipeline.vae.decode, dynamic=False)
+
+        # Run dummy generations at every batch size the batcher can produce so
+        # no request pays compile cost. Three steps get past CUDA graph warmup
+        # and recording, so requests only replay
+        for batch_size in range(1, max(1, settings.max_batch_size) + 1):
+            logger.info("Warming up compiled pipeline at batch size %s", batch_size)
+            warmup_kwargs = {"prompt": ["warmup"] * batch_size, "num_inference_steps": 3}
+            if settings.enable_ip_adapter:
+                # One reference for the whole batch, as prepare_batch passes it
+                warmup_kwargs["ip_adapter_image"] = [Image.new("RGB", (224, 224))]
+            with torch.inference_mode():
+                self.pipeline(**warmup_kwargs)
+
     def _load_lora(self):
         """Load LoRA weights"""
         logger.info("Attaching LoRA weights")
@@ -106,40 +281,71 @@ class TextToImagePipeline:
         
         # Check if already loaded
         if adapter_name in self.loaded_loras:
-            logger.info("LoRA {} already loaded with adapter name {}".format(lora_id, adapter_name))
+            self.loaded_loras.move_to_end(adapter_name)
+            logger.info("LoRA %s already loaded with adapter name %s", lora_id, adapter_name)
             return True
         
+        # Evict least recently used LoRAs to keep GPU memory bounded
+        while self.loaded_loras and len(self.loaded_loras) >= settings.max_loaded_loras:
+            oldest_adapter = next(iter(self.loaded_loras))
+            logger.info("Evicting least recently used LoRA adapter %s", oldest_adapter)
+            if not self.unload_lora(oldest_adapter):
+                break
+        
         try:
             # Download LoRA from S3
             lora_path = s3_client.download_lora(lora_id)
             if not lora_path:
-                logger.error("Failed to download LoRA: {}".format(lora_id))
+                logger.error("Failed to download LoRA: %s", lora_id)
                 return False
             
             # Load LoRA weights
-            logger.info("Loading LoRA {} with adapter name {}".format(lora_id, adapter_name))
+            logger.info("Loading LoRA %s with adapter name %s", lora_id, adapter_name)
             self.pipeline.load_lora_weights(
                 lora_path,
                 adapter_name=adapter_name
             )
             
-            # Set adapter as active (if pipeline supports it)
-            try:
-                if hasattr(self.pipeline, 'set_adapters'):
-                    self.pipeline.set_adapters([adapter_name])
-                    logger.info("Set LoRA adapter {} as active".format(adapter_name))
-            except Exception as e:
-                logger.warning("Could not set adapter (may not be supported): {}".format(str(e)))
+            # Loading activates the new adapter; activate_lora restores the right set
+            self._adapters_changed = True
             
             # Track loaded LoRA
             self.loaded_loras[adapter_name] = lora_id
-            logger.info("Successfully loaded LoRA {} with adapter name {}".format(lora_id, adapter_name))
+            logger.info("Successfully loaded LoRA %s with adapter name %s", lora_id, adapter_name)
             return True
             
         except Exception as e:
-            logger.error("Failed to load LoRA {}: {}".format(lora_id, str(e)))
+            logger.error("Failed to load LoRA %s: %s", lora_id, e)
             return False
     
+    def activate_lora(self, lora_id: Optional[str] = None):
+        """
+        Make lora_id the only dynamic LoRA enabled (None disables them), loading
+        it first if needed.
+        
+        The active adapter is pipeline-wide state, so this must run on the
+        inference thread right before the batch that uses it.
+        """
+        adapter_name = None
+        if lora_id:
+            adapter_name = f"lora_{lora_id}"
+            if not self.load_lora(lora_id, adapter_name):
+                logger.warning("Failed to load LoRA %s, continuing without it", lora_id)
+                adapter_name = None
+        
+        if adapter_name == self.active_adapter and not self._adapters_changed:
+            return
+        
+        adapters = self.base_adapters + ([adapter_name] if adapter_name else [])
+        if adapters:
+            self.pipeline.enable_lora()
+            self.pipeline.set_adapters(adapters, [1.0] * len(adapters))
+        elif self.loaded_loras:
+            self.pipeline.disable_lora()
+        self.active_adapter = adapter_name
+        self._adapters_changed = False
+        logger.debug("Active LoRA adapters: %s", adapters)
+    
     def unload_lora(self, adapter_name: Optional[str] = None) -> bool:
         """
         Unload a LoRA by adapter name.
@@ -158,24 +364,29 @@ class TextToImagePipeline:
             if adapter_name:
                 # Unload specific adapter
                 if adapter_name in self.loaded_loras:
-                    logger.info("Unloading LoRA with adapter name {}".format(adapter_name))
-                    # Note: diffusers doesn't have a direct unload method
-                    # We'll need to set adapter weights to zero or reload pipeline
-                    # For now, just remove from tracking
+                    logger.info("Unloading LoRA with adapter name %s", adapter_name)
+                    self.pipeline.delete_adapters([adapter_name])
                     del self.loaded_loras[adapter_name]
-                    logger.info("Removed LoRA {} from tracking".format(adapter_name))
+                    if self.active_adapter == adapter_name:
+                        self.active_adapter = None
+                    torch.cuda.empty_cache()
+                    logger.info("Unloaded LoRA %s", adapter_name)
                     return True
                 else:
-                    logger.warning("Adapter {} not found in loaded LoRAs".format(adapter_name))
+                    logger.warning("Adapter %s not found in loaded LoRAs", adapter_name)
                     return False
             else:
-                # Unload all LoRAs (clear tracking)
+                # Unload all dynamically loaded LoRAs
                 logger.info("Clearing all loaded LoRAs")
+                if self.loaded_loras:
+                    self.pipeline.delete_adapters(list(self.loaded_loras))
                 self.loaded_loras.clear()
+                self.active_adapter = None
+                torch.cuda.empty_cache()
                 return True
                 
         except Exception as e:
-            logger.error("Failed to unload LoRA: {}".format(str(e)))
+            logger.error("Failed to unload LoRA: %s", e)
             return False
     
     def is_lora_loaded(self, lora_id: str) -> bool:
@@ -0,0 +1,127 @@
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+import torch
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def _encode(pipeline, texts: List[str], encoder_index: int) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+    """
+    Run one SDXL text encoder the same way StableDiffusionXLPipeline.encode_prompt does.
+
+    Returns:
+        Penultimate hidden states and, for the projection encoder, pooled embeddings
+    """
+    tokenizer = (pipeline.tokenizer, pipeline.tokenizer_2)[encoder_index]
+    text_encoder = (pipeline.text_encoder, pipeline.text_encoder_2)[encoder_index]
+
+    input_ids = tokenizer(
+        texts,
+        padding="max_length",
+        max_length=tokenizer.model_max_length,
+        truncation=True,
+        return_tensors="pt",
+    ).input_ids
+    output = text_encoder(input_ids.to(text_encoder.device), output_hidden_states=True)
+
+    # Only the final (projection) encoder provides the pooled embedding
+    pooled = output[0] if output[0].ndim == 2 else None
+    return output.hidden_states[-2], pooled
+
+
+class PromptEmbeddingCache:
+    """
+    LRU cache of SDXL text-encoder outputs for prompts that repeat across requests.
+
+    SDXL encodes prompt with CLIP-L and prompt_2 with OpenCLIP-G, and the pooled
+    embedding comes from OpenCLIP-G alone. Style prompts are passed as prompt_2
+    and most requests use the default negative prompt, so their encoder outputs
+    are the same for every request and only need to be computed once. Entries
+    are keyed by (encoder, adapter_name, text) since a LoRA may patch the text
+    encoders.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+
+    def clear(self):
+        self._entries.clear()
+
+    def encode(self, pipeline, texts: List[str], encoder_index: int, adapter_name: Optional[str] = None,
+               use_cache: bool = True) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        """Encode texts with one text encoder, serving repeated texts from the cache"""
+        if not use_cache:
+            # Still encode each distinct text in the batch only once
+            unique = list(dict.fromkeys(texts))
+            hidden, pooled = _encode(pipeline, unique, encoder_index)
+            if len(unique) == len(texts):
+                return hidden, pooled
+            index = torch.tensor([unique.index(text) for text in texts], device=hidden.device)
+            return hidden[index], pooled[index] if pooled is not None else None
+
+        missing = [text for text in dict.fromkeys(texts)
+                   if (encoder_index, adapter_name, text) not in self._entries]
+        if missing:
+            hidden, pooled = _encode(pipeline, missing, encoder_index)
+            for i, text in enumerate(missing):
+                self._entries[(encoder_index, adapter_name, text)] = (
+                    hidden[i:i + 1], pooled[i:i + 1] if pooled is not None else None
+                )
+
+        entries = []
+        for text in texts:
+            key = (encoder_index, adapter_name, text)
+            self._entries.move_to_end(key)
+            entries.append(self._entries[key])
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+        hidden = torch.cat([entry[0] for entry in entries])
+        pooled = torch.cat([entry[1] for entry in entries]) if entries[0][1] is not None else None
+        return hidden, pooled
+
+    def warm(self, pipeline, style_prompts: List[str], negative_prompts: List[str]):
+        """Precompute the embeddings of the default style and negative prompts"""
+        with torch.inference_mode():
+            self.encode(pipeline, style_prompts, 1)
+            self.encode(pipeline, negative_prompts, 0)
+            self.encode(pipeline, negative_prompts, 1)
+        logger.info("Cached embeddings for %s style and %s negative prompt(s)",
+                    len(style_prompts), len(negative_prompts))
+
+
+def encode_batch_prompts(pipeline, prompts: List[str], prompts_2: Optional[List[str]],
+                         negative_prompts: List[str], adapter_name: Optional[str] = None) -> Dict[str, torch.Tensor]:
+    """
+    Build the prompt_embeds family of pipeline kwargs for a batch, serving the
+    style prompts (prompts_2) and negative prompts from the embedding cache.
+    """
+    cache = prompt_embedding_cache
+
+    hidden_1, _ = cache.encode(pipeline, prompts, 0, adapter_name, use_cache=False)
+    if prompts_2 is not None:
+        hidden_2, pooled = cache.encode(pipeline, prompts_2, 1, adapter_name)
+    else:
+        hidden_2, pooled = cache.encode(pipeline, prompts, 1, adapter_name, use_cache=False)
+
+    negative_hidden_1, _ = cache.encode(pipeline, negative_prompts, 0, adapter_name)
+    negative_hidden_2, negative_pooled = cache.encode(pipeline, negative_prompts, 1, adapter_name)
+
+    dtype = pipeline.text_encoder_2.dtype
+    prompt_embeds = torch.cat([hidden_1, hidden_2], dim=-1).to(dtype)
+    negative_prompt_embeds = torch.cat([negative_hidden_1, negative_hidden_2], dim=-1).to(dtype)
+
+    return {
+        "prompt_embeds": prompt_embeds,
+        "pooled_prompt_embeds": pooled.to(dtype),
+        "negative_prompt_embeds": negative_prompt_embeds,
+        "negative_pooled_prompt_embeds": negative_pooled.to(dtype),
+    }
+
+
+# Global prompt embedding cache instance
+prompt_embedding_cache = PromptEmbeddingCache(settings.prompt_embedding_cache_size)
@@ -0,0 +1,91 @@
+import logging
+from typing import Any, Dict, Optional
+import torch
+from diffusers.models.modeling_outputs import Transformer2DModelOutput
+from diffusers.models.transformers.transformer_2d import Transformer2DModel
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class StepCache:
+    """
+    Reuses the UNet's transformer block outputs across adjacent denoising steps.
+
+    Neighbouring steps produce nearly identical attention/feed-forward outputs,
+    so on "reuse" steps each Transformer2DModel returns its input plus the
+    residual it computed on the last full step instead of running again.
+    A step is computed in full either every `interval` steps (FORA) or, when
+    rel_l1_threshold is set, once the latents have drifted by more than the
+    threshold (relative L1) since the last full step (TeaCache).
+    """
+
+    def __init__(self, interval: int, rel_l1_threshold: float):
+        self.interval = max(1, interval)
+        self.rel_l1_threshold = rel_l1_threshold
+        self.reuse = False
+        self._residuals: Dict[int, torch.Tensor] = {}
+        self._previous_sample: Optional[torch.Tensor] = None
+        self._accumulated_distance = 0.0
+
+    def begin_step(self, step: int, sample: torch.Tensor):
+        """Decide whether the UNet call for this denoising step may reuse residuals"""
+        if step == 0 or self._previous_sample is None or self._previous_sample.shape != sample.shape:
+            # New generation (or batch size): everything must be recomputed
+            self._residuals.clear()
+            self._accumulated_distance = 0.0
+            self.reuse = False
+        elif self.rel_l1_threshold > 0:
+            previous = self._previous_sample
+            distance = ((sample - previous).abs().mean() / previous.abs().mean()).item()
+            self._accumulated_distance += distance
+            self.reuse = self._accumulated_distance < self.rel_l1_threshold
+            if not self.reuse:
+                self._accumulated_distance = 0.0
+        else:
+            self.reuse = step % self.interval != 0
+        self._previous_sample = sample
+
+    def wrap(self, block: Transformer2DModel):
+        """Route a transformer block's forward through the cache"""
+        forward = block.forward
+        key = id(block)
+
+        def cached_forward(hidden_states: torch.Tensor, *args, **kwargs) -> Any:
+            return_dict = kwargs.get("return_dict", True)
+            residual = self._residuals.get(key)
+            if self.reuse and residual is not None and residual.shape == hidden_states.shape:
+                output = hidden_states + residual
+                return Transformer2DModelOutput(sample=output) if return_dict else (output,)
+
+            result = forward(hidden_states, *args, **kwargs)
+            output = result.sample if return_dict else result[0]
+            self._residuals[key] = output - hidden_states
+            return result
+
+        block.forward = cached_forward
+
+
+def install_step_cache(pipeline) -> Optional[StepCache]:
+    """
+    Attach a StepCache to the pipeline's UNet if step_cache_interval or
+    step_cache_rel_l1_threshold enable it. Call once, before compiling.
+    """
+    if settings.step_cache_interval <= 1 and settings.step_cache_rel_l1_threshold <= 0:
+        return None
+
+    cache = StepCache(settings.step_cache_interval, settings.step_cache_rel_l1_threshold)
+    blocks = [module for module in pipeline.unet.modules() if isinstance(module, Transformer2DModel)]
+    for block in blocks:
+        cache.wrap(block)
+
+    def begin_step(unet, args, kwargs):
+        # Schedulers reset step_index to None at the start of every generation
+        step = pipeline.scheduler.step_index or 0
+        sample = args[0] if args else kwargs["sample"]
+        cache.begin_step(step, sample)
+
+    pipeline.unet.register_forward_pre_hook(begin_step, with_kwargs=True)
+    logger.info("Installed step cache on %s transformer blocks (interval=%s, rel_l1_threshold=%s)",
+                len(blocks), cache.interval, cache.rel_l1_threshold)
+    return cache
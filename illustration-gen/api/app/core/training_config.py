@@ -1,3 +1,4 @@
+from functools import lru_cache
 from pydantic_settings import BaseSettings
 
 
@@ -27,6 +28,10 @@ class TrainingConfig(BaseSettings):
     mixed_precision: str = "bf16"
     gradient_checkpointing: bool = True
     
+    # GPU for the training subprocess. Inference runs on GPU 0; if this GPU
+    # does not exist (or is 0), training shares GPU 0 and pauses inference
+    train_gpu_id: int = 1
+    
     # Training output
     output_dir: str = "/tmp/lora_training"
     
@@ -54,7 +59,10 @@ class TrainingConfig(BaseSettings):
         return self.instance_prompt_template.format(token=self.instance_token)
 
 
-training_config = TrainingConfig()
-
+@lru_cache(maxsize=1)
+def get_training_config() -> TrainingConfig:
+    """Return the process-wide training config, parsing .env only once"""
+    return TrainingConfig()
 
 
+training_config = get_training_config()
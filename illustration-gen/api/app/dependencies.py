@@ -0,0 +1,44 @@
+from typing import Any, Callable, Dict, Type
+from fastapi import Request
+from fastapi.exceptions import RequestValidationError
+from pydantic import BaseModel, ValidationError
+from app.services.illustration_service import IllustrationService
+from app.services.subject_customization_service import SubjectCustomizationService
+
+
+def get_illustration_service(request: Request) -> IllustrationService:
+    """Dependency to get the process-wide illustration service created at startup"""
+    return request.app.state.illustration_service
+
+
+def get_subject_customization_service(request: Request) -> SubjectCustomizationService:
+    """Dependency to get the process-wide subject customization service instance.
+
+    Shared so that training job status survives across requests.
+    """
+    return request.app.state.subject_customization_service
+
+
+def json_body(model: Type[BaseModel]) -> Callable:
+    """Dependency that validates the raw JSON request body with model.model_validate_json.
+
+    Skips FastAPI's json.loads -> dict -> validate round trip; pydantic-core
+    parses and validates the bytes in one pass.
+    """
+    async def parse(request: Request) -> BaseModel:
+        try:
+            return model.model_validate_json(await request.body())
+        except ValidationError as e:
+            errors = [dict(error, loc=("body",) + tuple(error["loc"])) for error in e.errors(include_url=False)]
+            raise RequestValidationError(errors)
+    return parse
+
+
+def json_body_openapi(model: Type[BaseModel]) -> Dict[str, Any]:
+    """openapi_extra documenting a body read through json_body"""
+    return {
+        "requestBody": {
+            "required": True,
+            "content": {"application/json": {"schema": model.model_json_schema()}},
+        }
+    }
@@ -1,21 +1,73 @@
+import asyncio
 import os
-import tempfile
 import logging
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from app.core.config import settings
+
+# Must be set before the first CUDA allocation; an explicit environment
+# variable still wins
+if settings.cuda_alloc_conf:
+    os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", settings.cuda_alloc_conf)
+
+from app.core.pipeline import TextToImagePipeline, inference_executor
+from app.core.batcher import DiffusionBatcher
+from app.services.illustration_service import IllustrationService
+from app.services.subject_customization_service import SubjectCustomizationService
+from app.utils.image_utils import IMAGE_DIR
 from app.api.endpoints import images, health
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Keep library logging quiet on the model-load and inference paths
+if not settings.debug:
+    for library_logger in ("diffusers", "transformers"):
+        logging.getLogger(library_logger).setLevel(logging.WARNING)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Load the model and create the process-wide services before accepting traffic"""
+    logger.info("Starting up Image Generation API...")
+    logger.info("App name: %s", settings.app_name)
+    logger.info("Model path: %s", settings.model_path)
+    logger.info("CUDA available: %s", os.getenv('CUDA_VISIBLE_DEVICES', 'Not set'))
+
+    # Load the diffusion pipeline up front so the first request does not pay
+    # the model download/load cost
+    try:
+        # On the inference thread, so CUDA graphs recorded during warmup are
+        # the ones batches replay
+        await asyncio.get_running_loop().run_in_executor(inference_executor, TextToImagePipeline().start)
+        logger.info("Diffusion pipeline loaded")
+    except Exception as e:
+        logger.error("Failed to preload diffusion pipeline: %s", e)
+
+    app.state.illustration_service = IllustrationService()
+    if settings.preload_lora_ids:
+        app.state.illustration_service.prewarm_loras(
+            [lora_id.strip() for lora_id in settings.preload_lora_ids.split(",") if lora_id.strip()]
+        )
+    app.state.subject_customization_service = SubjectCustomizationService()
+    DiffusionBatcher().start()
+
+    yield
+
+    logger.info("Shutting down Image Generation API...")
+    await app.state.illustration_service.stop()
+    await DiffusionBatcher().stop()
+
+
 # Create FastAPI app
 app = FastAPI(
     title=settings.app_name,
     description="A FastAPI service for generating images using diffusion models",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # Configure CORS
@@ -28,12 +80,7 @@ app.add_middleware(
 )
 
 # Setup static files for generated images
-image_dir = os.path.join(tempfile.gettempdir(), "images")
-if not os.path.exists(image_dir):
-    os.makedirs(image_dir)
-    logger.info("Created image directory: {}".format(image_dir))
-
-app.mount("/images", StaticFiles(directory=image_dir), name="images")
+app.mount("/images", StaticFiles(directory=IMAGE_DIR), name="images")
 
 # Include API routes
 app.include_router(images.router, prefix="/v1/images", tags=["images"])
@@ -50,21 +97,12 @@ async def root():
     }
 
 
-@app.on_event("startup")
-async def startup_event():
-    """Startup event handler"""
-    logger.info("Starting up Image Generation API...")
-    logger.info("App name: {}".format(settings.app_name))
-    logger.info("Model path: {}".format(settings.model_path))
-    logger.info("CUDA available: {}".format(os.getenv('CUDA_VISIBLE_DEVICES', 'Not set')))
-
-
-@app.on_event("shutdown")
-async def shutdown_event():
-    """Shutdown event handler"""
-    logger.info("Shutting down Image Generation API...")
-
-
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(
+        app,
+        host=settings.uvicorn_host,
+        port=settings.uvicorn_port,
+        loop=settings.uvicorn_loop,
+        http=settings.uvicorn_http
+    )
@@ -2,6 +2,7 @@ from fastapi import HTTPException, status, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from app.core.config import settings
 import logging
+import secrets
 
 logger = logging.getLogger(__name__)
 
@@ -41,9 +42,9 @@ def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
             headers={"WWW-Authenticate": "Bearer"},
         )
     
-    # Verify token
-    if credentials.credentials != settings.auth_token:
-        logger.warning(f"Invalid token attempt from client")
+    # Verify token; compare bytes, since compare_digest rejects non-ASCII str
+    if not secrets.compare_digest(credentials.credentials.encode(), settings.auth_token.encode()):
+        logger.warning("Invalid token attempt from client")
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid authorization token",
@@ -53,11 +54,6 @@ def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
     logger.debug("Token verification successful")
     return True
 
-def get_auth_dependency():
-    """
-    Get authentication dependency based on configuration.
-    
-    Returns:
-        Dependency function
-    """
-    return verify_token  # Return the function directly
\ No newline at end of file
+# Router-level auth dependencies, resolved once at import. When authentication
+# is disabled no dependency is registered, so requests skip the check entirely.
+auth_dependencies = [Depends(verify_token)] if settings.auth_enabled else []
@@ -1,9 +1,14 @@
-from pydantic import BaseModel
-from typing import Optional, List, Dict, Any
+from pydantic import BaseModel, ConfigDict
+from typing import Optional, List
 from app.core.config import settings
 
 
-class GenerateIllustrationInput(BaseModel):
+class Schema(BaseModel):
+    """Base for API schemas: immutable, so instances are safe to share"""
+    model_config = ConfigDict(frozen=True)
+
+
+class GenerateIllustrationInput(Schema):
     prompt: str
     num_inference_steps: Optional[int] = settings.default_num_inference_steps
     style: Optional[str] = None
@@ -12,7 +17,7 @@ class GenerateIllustrationInput(BaseModel):
     negative_prompt: Optional[str] = settings.default_negative_prompt
 
 
-class GenerateMemoryIllustrationInput(BaseModel):
+class GenerateMemoryIllustrationInput(Schema):
     user_id: str
     prompt: str
     num_inference_steps: Optional[int] = settings.default_num_inference_steps
@@ -22,7 +27,17 @@ class GenerateMemoryIllustrationInput(BaseModel):
     lora_id: Optional[str] = None
 
 
-class GenerateSubjectIllustrationInput(BaseModel):
+class GenerateMemoryIllustrationsInput(Schema):
+    user_id: str
+    prompts: List[str]
+    num_inference_steps: Optional[int] = settings.default_num_inference_steps
+    ip_adapter_scale: Optional[float] = settings.default_ip_adapter_scale
+    negative_prompt: Optional[str] = settings.default_negative_prompt
+    style_prompt: Optional[str] = settings.default_memory_style_prompt
+    lora_id: Optional[str] = None
+
+
+class GenerateSubjectIllustrationInput(Schema):
     user_id: str
     num_inference_steps: Optional[int] = settings.default_num_inference_steps
     ip_adapter_scale: Optional[float] = settings.default_ip_adapter_scale
@@ -31,28 +46,29 @@ class GenerateSubjectIllustrationInput(BaseModel):
     lora_id: Optional[str] = None
 
 
-class ImageData(BaseModel):
+class ImageData(Schema):
     url: str
 
 
-class S3ImageData(BaseModel):
+class S3ImageData(Schema):
     s3_uri: str
 
 
-class ImageResponse(BaseModel):
+class ImageResponse(Schema):
     data: List[ImageData]
 
 
-class S3ImageResponse(BaseModel):
+class S3ImageResponse(Schema):
     data: List[S3ImageData]
 
 
-class HealthResponse(BaseModel):
+class HealthResponse(Schema):
     status: str
     message: str
+    queue_depth: Optional[int] = None
 
 
-class TrainLoRAInput(BaseModel):
+class TrainLoRAInput(Schema):
     user_id: str
     training_images_s3_path: str
     lora_name: Optional[str] = None
@@ -62,16 +78,30 @@ class TrainLoRAInput(BaseModel):
     lora_alpha: Optional[int] = None
 
 
-class TrainLoRAResponse(BaseModel):
+class TrainLoRAResponse(Schema):
     job_id: str
     status: str
     lora_id: Optional[str] = None
     lora_s3_uri: Optional[str] = None
 
 
-class TrainingStatusResponse(BaseModel):
+class TrainingStatusResponse(Schema):
     job_id: str
     status: str
     lora_id: Optional[str] = None
     lora_s3_uri: Optional[str] = None
-    error_message: Optional[str] = None
\ No newline at end of file
+    error_message: Optional[str] = None
+
+
+class GenerationJobResponse(Schema):
+    job_id: str
+    status: str
+
+
+class GenerationJobStatusResponse(Schema):
+    job_id: str
+    status: str
+    step: int = 0
+    num_inference_steps: Optional[int] = None
+    s3_uri: Optional[str] = None
+    error_message: Optional[str] = None
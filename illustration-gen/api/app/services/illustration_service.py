@@ -1,9 +1,21 @@
 import asyncio
 import logging
-import os
-from diffusers import StableDiffusionXLPipeline
-from app.core.pipeline import TextToImagePipeline
-from app.utils.image_utils import subject_generation_inference, memory_generation_inference, inference, save_image
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from io import BytesIO
+from typing import Any, Callable, Dict, List, Optional
+from PIL import Image
+from app.core.pipeline import TextToImagePipeline, gpu_lock
+from app.core.batcher import DiffusionBatcher
+from app.utils.image_utils import (
+    subject_generation_request,
+    memory_generation_request,
+    encode_ip_adapter_image,
+    save_image,
+)
 from app.utils.s3_utils import s3_client
 from app.core.config import settings
 
@@ -12,159 +24,335 @@ logger = logging.getLogger(__name__)
 
 class IllustrationService:
     def __init__(self):
-        self.pipeline = TextToImagePipeline()
-        if not self.pipeline.pipeline:  # Only start if not already initialized
-            self.pipeline.start()
+        self.pipeline = TextToImagePipeline()  # Started once by the app lifespan
+        self.batcher = DiffusionBatcher()
+        # S3 transfers and image decoding get their own threads so they never
+        # wait behind (or delay) the inference calls in the default executor
+        self._io_executor = ThreadPoolExecutor(max_workers=settings.io_workers, thread_name_prefix="illustration-io")
+        # IP-Adapter reference image embeddings: s3_key -> (etag, embeddings)
+        self._reference_cache = OrderedDict()
+        self._reference_cache_lock = threading.Lock()
+        # Async generation jobs (job_id -> status dict), oldest first
+        self._jobs = OrderedDict()
+        # The event loop only keeps weak references to tasks; hold running jobs here
+        self._jobs_tasks = set()
+    
+    def prewarm_loras(self, lora_ids: List[str]):
+        """
+        Download LoRAs in parallel and load them into the pipeline, inactive, so
+        the first request for each skips the S3 fetch and adapter injection.
+        
+        Only the first max_loaded_loras ids are loaded; the rest would be evicted.
+        """
+        lora_ids = list(dict.fromkeys(lora_ids))[:settings.max_loaded_loras]
+        if not lora_ids or not self.pipeline.ready:
+            return
+        
+        logger.info("Prewarming %s LoRA(s)", len(lora_ids))
+        # Fill the local cache concurrently; load_lora then reads from disk
+        list(self._io_executor.map(s3_client.download_lora, lora_ids))
+        
+        with gpu_lock:
+            for lora_id in lora_ids:
+                self.pipeline.load_lora(lora_id)
+            self.pipeline.activate_lora(None)
+    
+    async def _run_io(self, func: Callable, *args) -> Any:
+        """Run a blocking I/O call on the I/O thread pool"""
+        return await asyncio.get_running_loop().run_in_executor(self._io_executor, func, *args)
+    
+    async def _prefetch_lora(self, lora_id: Optional[str]):
+        """
+        Download a LoRA that is not loaded yet into the local cache on the I/O
+        pool, so the inference thread loads it from disk instead of fetching it
+        from S3 while holding the GPU.
+        """
+        if lora_id and not self.pipeline.is_lora_loaded(lora_id):
+            await self._run_io(s3_client.download_lora, lora_id)
+    
+    def _get_reference_image(self, key: str):
+        """
+        Get a user's IP-Adapter reference image from S3, cached per object ETag.
+        
+        Cached images are revalidated with a conditional GET, so an unchanged
+        object costs one round trip and no body. When the pipeline has an
+        IP-Adapter image encoder, the image is cached as its encoded
+        embeddings, so repeat requests also skip the decode and image encoder.
+        
+        Returns:
+            (image_embeds, negative_image_embeds) (or PIL image), or None if the
+            object does not exist
+        """
+        with self._reference_cache_lock:
+            cached = self._reference_cache.get(key)
+        
+        etag, data = s3_client.download_image_bytes_if_changed(key, cached[0] if cached else None)
+        if etag is None:
+            return None
+        if data is None:
+            with self._reference_cache_lock:
+                if key in self._reference_cache:
+                    self._reference_cache.move_to_end(key)
+            logger.debug("Using cached reference image for %s", key)
+            return cached[1]
+        
+        try:
+            with Image.open(BytesIO(data)) as img:
+                image = img.convert("RGB")
+        except Exception as img_error:
+            raise Exception("Downloaded image is not a valid image file: {}".format(str(img_error)))
+        
+        if getattr(self.pipeline.pipeline, "image_encoder", None) is not None:
+            image = encode_ip_adapter_image(self.pipeline.pipeline, image)
+        
+        with self._reference_cache_lock:
+            self._reference_cache[key] = (etag, image)
+            while len(self._reference_cache) > settings.reference_image_cache_size:
+                self._reference_cache.popitem(last=False)
+        
+        return image
     
     async def generate_illustration(self, prompt: str, num_inference_steps: int = None, 
                                   reference_image_url: str = None, ip_adapter_scale: float = None, 
                                   negative_prompt: str = None):
         """Generate an illustration from a text prompt and optional reference image"""
         try:
-            loop = asyncio.get_event_loop()
-            
-            # Run inference in executor to avoid blocking (reuse existing pipeline)
-            output = await loop.run_in_executor(
-                None, 
-                lambda: subject_generation_inference(
-                    self.pipeline.pipeline, num_inference_steps, reference_image_url, 
-                    ip_adapter_scale, negative_prompt
+            # Run inference through the batcher (reuse existing pipeline)
+            output = await self.batcher.submit(
+                subject_generation_request(
+                    num_inference_steps, reference_image_url, ip_adapter_scale, negative_prompt
                 )
             )
             
-            logger.info("Generated illustration for prompt: {}".format(prompt))
-            image_url = save_image(output)
+            logger.info("Generated illustration for prompt: %s", prompt)
+            image_url = await self._run_io(save_image, output)
             
             return {"data": [{"url": image_url}]}
             
         except Exception as e:
-            logger.error("Illustration generation failed: {}".format(str(e)))
+            logger.error("Illustration generation failed: %s", e)
             raise Exception("Illustration generation failed: {}".format(str(e)))
     
     async def generate_memory_illustration(self, user_id: str, prompt: str, num_inference_steps: int = None, 
                                          ip_adapter_scale: float = None, negative_prompt: str = None, 
-                                         style_prompt: str = None, lora_id: str = None):
+                                         style_prompt: str = None, lora_id: str = None,
+                                         on_step: Optional[Callable[[int, int], None]] = None):
         """Generate a memory illustration using user's avatar as IP-Adapter input"""
         try:
-            # Load LoRA if provided
-            adapter_name = None
-            if lora_id:
-                adapter_name = f"lora_{lora_id}"
-                if not self.pipeline.is_lora_loaded(lora_id):
-                    logger.info("Loading LoRA {} for memory illustration".format(lora_id))
-                    if not self.pipeline.load_lora(lora_id, adapter_name):
-                        logger.warning("Failed to load LoRA {}, continuing without it".format(lora_id))
-                else:
-                    logger.debug("LoRA {} already loaded".format(lora_id))
-            # Download user's avatar from S3
+            # The batcher loads and activates the LoRA right before the batch runs
+            adapter_name = f"lora_{lora_id}" if lora_id else None
+            # Get user's avatar from S3 (or the reference cache)
             avatar_key = s3_client.get_avatar_key(user_id)
-            logger.info("Downloading avatar from S3: {}".format(avatar_key))
-            avatar_local_path = s3_client.download_image(avatar_key)
+            # S3 and image decoding run off the event loop so they overlap with
+            # the batch currently denoising
+            avatar_image, _ = await asyncio.gather(
+                self._run_io(self._get_reference_image, avatar_key),
+                self._prefetch_lora(lora_id)
+            )
             
-            if not avatar_local_path:
+            if avatar_image is None:
                 raise Exception("Failed to download user avatar from S3. Make sure avatar exists at: {}".format(avatar_key))
             
-            # Generate illustration with avatar as reference
-            loop = asyncio.get_event_loop()
-            
-            # Run inference with avatar as IP-Adapter input (reuse existing pipeline)
-            output = await loop.run_in_executor(
-                None, 
-                lambda: memory_generation_inference(
-                    self.pipeline.pipeline, prompt, num_inference_steps, avatar_local_path, 
-                    ip_adapter_scale, negative_prompt, style_prompt, adapter_name
-                )
+            # Run inference with avatar as IP-Adapter input, batched with
+            # concurrent compatible requests (reuse existing pipeline)
+            request = memory_generation_request(
+                prompt, num_inference_steps, avatar_image, 
+                ip_adapter_scale, negative_prompt, style_prompt, adapter_name
             )
+            request["lora_id"] = lora_id
+            request["on_step"] = on_step
+            output = await self.batcher.submit(request)
             
             # Upload generated image directly to S3 from memory
             generated_key = s3_client.get_generated_key(user_id, "memory")
-            s3_uri = s3_client.upload_image_from_memory(output, generated_key)
-            
-            # Clean up avatar file
-            os.unlink(avatar_local_path)
+            s3_uri = await self._run_io(s3_client.upload_image_from_memory, output, generated_key)
             
             if not s3_uri:
                 raise Exception("Failed to upload generated illustration to S3")
             
-            logger.info("Generated memory illustration for user: {}".format(user_id))
+            logger.info("Generated memory illustration for user: %s", user_id)
             
-            # Note: We keep LoRA loaded for potential reuse (can be unloaded if needed)
-            # Uncomment below to unload after generation:
-            # if lora_id:
-            #     self.pipeline.unload_lora(f"lora_{lora_id}")
+            # LoRAs stay loaded for reuse; TextToImagePipeline evicts the least
+            # recently used one once max_loaded_loras is reached
             
             return {"data": [{"s3_uri": s3_uri}]}
             
         except Exception as e:
-            logger.error("Memory illustration generation failed: {}".format(str(e)))
+            logger.error("Memory illustration generation failed: %s", e)
             raise Exception("Memory illustration generation failed: {}".format(str(e)))
     
+    async def generate_memory_illustrations(self, user_id: str, prompts: List[str], num_inference_steps: int = None,
+                                            ip_adapter_scale: float = None, negative_prompt: str = None,
+                                            style_prompt: str = None, lora_id: str = None):
+        """
+        Generate memory illustrations for several prompts of one user.
+        
+        The avatar is fetched once, and all prompts are submitted together so
+        the batcher runs them in as few pipeline calls as possible.
+        """
+        try:
+            adapter_name = f"lora_{lora_id}" if lora_id else None
+            avatar_key = s3_client.get_avatar_key(user_id)
+            avatar_image, _ = await asyncio.gather(
+                self._run_io(self._get_reference_image, avatar_key),
+                self._prefetch_lora(lora_id)
+            )
+            
+            if avatar_image is None:
+                raise Exception("Failed to download user avatar from S3. Make sure avatar exists at: {}".format(avatar_key))
+            
+            requests = []
+            for prompt in prompts:
+                request = memory_generation_request(
+                    prompt, num_inference_steps, avatar_image,
+                    ip_adapter_scale, negative_prompt, style_prompt, adapter_name
+                )
+                request["lora_id"] = lora_id
+                requests.append(request)
+            outputs = await asyncio.gather(*(self.batcher.submit(request) for request in requests))
+            
+            s3_uris = await asyncio.gather(*(
+                self._run_io(s3_client.upload_image_from_memory, output, s3_client.get_generated_key(user_id, "memory"))
+                for output in outputs
+            ))
+            if not all(s3_uris):
+                raise Exception("Failed to upload generated illustrations to S3")
+            
+            logger.info("Generated %s memory illustrations for user: %s", len(s3_uris), user_id)
+            return {"data": [{"s3_uri": s3_uri} for s3_uri in s3_uris]}
+            
+        except Exception as e:
+            logger.error("Memory illustration batch generation failed: %s", e)
+            raise Exception("Memory illustration batch generation failed: {}".format(str(e)))
+    
     async def generate_subject_illustration(self, user_id: str, num_inference_steps: int = None, 
                                           ip_adapter_scale: float = None, negative_prompt: str = None, 
-                                          style_prompt: str = None, lora_id: str = None):
+                                          style_prompt: str = None, lora_id: str = None,
+                                          on_step: Optional[Callable[[int, int], None]] = None):
         """Generate a subject illustration using user's uploaded photo and special prompt"""
         try:
-            # Load LoRA if provided
-            adapter_name = None
-            if lora_id:
-                adapter_name = f"lora_{lora_id}"
-                if not self.pipeline.is_lora_loaded(lora_id):
-                    logger.info("Loading LoRA {} for subject illustration".format(lora_id))
-                    if not self.pipeline.load_lora(lora_id, adapter_name):
-                        logger.warning("Failed to load LoRA {}, continuing without it".format(lora_id))
-                else:
-                    logger.debug("LoRA {} already loaded".format(lora_id))
-            # Download user's subject image from S3
+            # The batcher loads and activates the LoRA right before the batch runs
+            adapter_name = f"lora_{lora_id}" if lora_id else None
+            # Get user's subject image from S3 (or the reference cache)
             subject_key = s3_client.get_subject_key(user_id)
-            logger.info("Downloading subject image from S3: {}".format(subject_key))
-            subject_local_path = s3_client.download_image(subject_key)
+            # S3 and image decoding run off the event loop so they overlap with
+            # the batch currently denoising
+            subject_image, _ = await asyncio.gather(
+                self._run_io(self._get_reference_image, subject_key),
+                self._prefetch_lora(lora_id)
+            )
             
-            if not subject_local_path:
+            if subject_image is None:
                 raise Exception("Failed to download user subject image from S3. Make sure subject image exists at: {}".format(subject_key))
             
-            # Verify the downloaded file is a valid image
-            try:
-                from PIL import Image
-                with Image.open(subject_local_path) as img:
-                    img.verify()  # Verify it's a valid image
-            except Exception as img_error:
-                raise Exception("Downloaded subject image is not a valid image file: {}".format(str(img_error)))       
-            
-            # Generate illustration with subject image as reference
-            loop = asyncio.get_event_loop()
-            
-            # Run inference with subject image as IP-Adapter input (reuse existing pipeline)
-            output = await loop.run_in_executor(
-                None, 
-                lambda: subject_generation_inference(
-                    self.pipeline.pipeline, num_inference_steps, subject_local_path, 
-                    ip_adapter_scale, negative_prompt, style_prompt, adapter_name
-                )
+            # Run inference with subject image as IP-Adapter input, batched with
+            # concurrent compatible requests (reuse existing pipeline)
+            request = subject_generation_request(
+                num_inference_steps, subject_image, 
+                ip_adapter_scale, negative_prompt, style_prompt, adapter_name
             )
+            request["lora_id"] = lora_id
+            request["on_step"] = on_step
+            output = await self.batcher.submit(request)
             
             # Upload generated image directly to S3 from memory
             generated_key = s3_client.get_generated_key(user_id, "subject")
-            s3_uri = s3_client.upload_image_from_memory(output, generated_key)
-            
-            # Clean up subject file
-            os.unlink(subject_local_path)
+            s3_uri = await self._run_io(s3_client.upload_image_from_memory, output, generated_key)
             
             if not s3_uri:
                 raise Exception("Failed to upload generated illustration to S3")
             
-            logger.info("Generated subject illustration for user: {}".format(user_id))
+            logger.info("Generated subject illustration for user: %s", user_id)
             
-            # Note: We keep LoRA loaded for potential reuse (can be unloaded if needed)
-            # Uncomment below to unload after generation:
-            # if lora_id:
-            #     self.pipeline.unload_lora(f"lora_{lora_id}")
+            # LoRAs stay loaded for reuse; TextToImagePipeline evicts the least
+            # recently used one once max_loaded_loras is reached
             
             return {"data": [{"s3_uri": s3_uri}]}
             
         except Exception as e:
-            logger.error("Subject illustration generation failed: {}".format(str(e)))
+            logger.error("Subject illustration generation failed: %s", e)
             raise Exception("Subject illustration generation failed: {}".format(str(e)))
     
+    def start_generation_job(self, generate: Callable[..., Any], *args) -> str:
+        """
+        Queue a generation in the background and return immediately with job_id.
+        
+        Args:
+            generate: generate_memory_illustration or generate_subject_illustration
+            *args: Positional arguments for generate
+        
+        Returns:
+            job_id: Unique identifier for this generation job
+        
+        Raises:
+            QueueFullError: If the batcher has no room for another request
+        """
+        # Hold the admission slot until the job finishes, not just for the HTTP request
+        admission = ExitStack()
+        admission.enter_context(self.batcher.admit())
+        
+        job_id = str(uuid.uuid4())
+        job = {
+            "status": "queued",
+            "step": 0,
+            "num_inference_steps": None,
+            "s3_uri": None,
+            "error_message": None,
+        }
+        self._jobs[job_id] = job
+        
+        def on_step(step: int, num_inference_steps: int):
+            # Called from the inference thread; plain assignments are safe under the GIL
+            job["status"] = "running"
+            job["step"] = step
+            job["num_inference_steps"] = num_inference_steps
+        
+        async def run_job():
+            with admission:
+                try:
+                    result = await generate(*args, on_step=on_step)
+                    job["s3_uri"] = result["data"][0]["s3_uri"]
+                    job["status"] = "completed"
+                except asyncio.CancelledError:
+                    job["error_message"] = "Cancelled by shutdown"
+                    job["status"] = "failed"
+                    raise
+                except Exception as e:
+                    job["error_message"] = str(e)
+                    job["status"] = "failed"
+            self._evict_finished_jobs()
+        
+        task = asyncio.get_running_loop().create_task(run_job())
+        self._jobs_tasks.add(task)
+        task.add_done_callback(self._jobs_tasks.discard)
+        logger.info("Queued generation job %s", job_id)
+        return job_id
+    
+    async def stop(self):
+        """Cancel generation jobs that are still running"""
+        tasks = list(self._jobs_tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    
+    def _evict_finished_jobs(self):
+        """Forget the oldest finished jobs beyond max_tracked_jobs"""
+        excess = len(self._jobs) - settings.max_tracked_jobs
+        for job_id in [job_id for job_id, job in self._jobs.items()
+                       if job["status"] in ("completed", "failed")][:max(0, excess)]:
+            del self._jobs[job_id]
+    
+    def get_job_status(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Get the status of a generation job.
+        
+        Returns:
+            Dict with status, step progress, s3_uri (if completed), error_message (if failed)
+            Returns None if job not found
+        """
+        job = self._jobs.get(job_id)
+        return dict(job) if job is not None else None
+    
     def is_ready(self) -> bool:
         """Check if the service is ready to generate illustrations"""
-        return self.pipeline.pipeline is not None
\ No newline at end of file
+        return self.pipeline.ready
\ No newline at end of file
@@ -1,13 +1,12 @@
+import asyncio
 import uuid
 import os
 import logging
-import subprocess
-import shutil
 import threading
 from typing import Optional, Dict, Any
+import torch
 from app.utils.s3_utils import s3_client
 from app.utils.training_utils import (
-    validate_images,
     prepare_training_dataset,
     get_instance_prompt,
     create_training_output_dir,
@@ -15,6 +14,7 @@ from app.utils.training_utils import (
 )
 from app.core.training_config import training_config
 from app.core.config import settings
+from app.core.pipeline import gpu_lock
 
 logger = logging.getLogger(__name__)
 
@@ -79,7 +79,6 @@ class SubjectCustomizationService:
                 
                 # Run training synchronously (this will block the thread)
                 # Use asyncio.run to execute async training in sync context
-                import asyncio
                 result = asyncio.run(self._train_lora_sync(
                     lora_id=lora_id,
                     user_id=user_id,
@@ -97,11 +96,11 @@ class SubjectCustomizationService:
                     self._job_status[job_id]["status"] = "completed"
                     self._job_status[job_id]["lora_s3_uri"] = result["lora_s3_uri"]
                 
-                logger.info("Training job {} completed successfully".format(job_id))
+                logger.info("Training job %s completed successfully", job_id)
                 
             except Exception as e:
                 error_message = str(e)
-                logger.error("Training job {} failed: {}".format(job_id, error_message))
+                logger.error("Training job %s failed: %s", job_id, error_message)
                 
                 # Update status to failed
                 with self._job_lock:
@@ -112,7 +111,7 @@ class SubjectCustomizationService:
         thread = threading.Thread(target=train_in_background, daemon=True)
         thread.start()
         
-        logger.info("Started training job {} for user {}".format(job_id, user_id))
+        logger.info("Started training job %s for user %s", job_id, user_id)
         return job_id
     
     def get_training_status(self, job_id: str) -> Optional[Dict[str, Any]]:
@@ -152,29 +151,23 @@ class SubjectCustomizationService:
         temp_files = []
         
         try:
-            logger.info("Starting LoRA training for user: {}, lora_id: {}".format(user_id, lora_id))
+            logger.info("Starting LoRA training for user: %s, lora_id: %s", user_id, lora_id)
             
             # Download training images from S3
-            logger.info("Downloading training images from: {}".format(training_images_s3_path))
-            image_paths = s3_client.download_images_from_s3_path(training_images_s3_path)
+            logger.info("Downloading training images from: %s", training_images_s3_path)
+            image_paths = await asyncio.to_thread(s3_client.download_images_from_s3_path, training_images_s3_path)
             
             if not image_paths:
                 raise ValueError("No training images found in S3 path: {}".format(training_images_s3_path))
             
             temp_dirs.append(os.path.dirname(image_paths[0]) if image_paths else None)
             
-            # Validate images
-            valid_images = validate_images(image_paths)
-            
-            if len(valid_images) < 1:
-                raise ValueError("Need at least 1 valid training image, found {}".format(len(valid_images)))
-            
             # Create output directory
             output_dir = create_training_output_dir(lora_id)
             temp_dirs.append(output_dir)
             
-            # Prepare dataset
-            dataset_dir = prepare_training_dataset(valid_images, output_dir)
+            # Validate images and prepare the dataset in a single decode pass
+            dataset_dir, num_images = prepare_training_dataset(image_paths, output_dir)
             
             # Get training parameters
             lr = learning_rate or self.training_config.learning_rate
@@ -184,7 +177,7 @@ class SubjectCustomizationService:
             instance_prompt = get_instance_prompt()
             
             # Run training
-            logger.info("Starting LoRA training with {} images".format(len(valid_images)))
+            logger.info("Starting LoRA training with %s images", num_images)
             lora_path = await self._run_training(
                 dataset_dir=dataset_dir,
                 output_dir=output_dir,
@@ -201,12 +194,12 @@ class SubjectCustomizationService:
             
             # Upload LoRA to S3
             logger.info("Uploading LoRA to S3")
-            lora_s3_uri = s3_client.upload_lora(lora_path, lora_id)
+            lora_s3_uri = await asyncio.to_thread(s3_client.upload_lora, lora_path, lora_id)
             
             if not lora_s3_uri:
                 raise Exception("Failed to upload LoRA to S3")
             
-            logger.info("Successfully trained and uploaded LoRA: {}".format(lora_id))
+            logger.info("Successfully trained and uploaded LoRA: %s", lora_id)
             
             return {
                 "lora_id": lora_id,
@@ -216,7 +209,7 @@ class SubjectCustomizationService:
             }
             
         except Exception as e:
-            logger.error("LoRA training failed: {}".format(str(e)))
+            logger.error("LoRA training failed: %s", e)
             raise Exception("LoRA training failed: {}".format(str(e)))
         
         finally:
@@ -276,29 +269,23 @@ class SubjectCustomizationService:
         temp_files = []
         
         try:
-            logger.info("Starting LoRA training for user: {}, lora_id: {}".format(user_id, lora_id))
+            logger.info("Starting LoRA training for user: %s, lora_id: %s", user_id, lora_id)
             
             # Download training images from S3
-            logger.info("Downloading training images from: {}".format(training_images_s3_path))
-            image_paths = s3_client.download_images_from_s3_path(training_images_s3_path)
+            logger.info("Downloading training images from: %s", training_images_s3_path)
+            image_paths = await asyncio.to_thread(s3_client.download_images_from_s3_path, training_images_s3_path)
             
             if not image_paths:
                 raise ValueError("No training images found in S3 path: {}".format(training_images_s3_path))
             
             temp_dirs.append(os.path.dirname(image_paths[0]) if image_paths else None)
             
-            # Validate images
-            valid_images = validate_images(image_paths)
-            
-            if len(valid_images) < 1:
-                raise ValueError("Need at least 1 valid training image, found {}".format(len(valid_images)))
-            
             # Create output directory
             output_dir = create_training_output_dir(lora_id)
             temp_dirs.append(output_dir)
             
-            # Prepare dataset
-            dataset_dir = prepare_training_dataset(valid_images, output_dir)
+            # Validate images and prepare the dataset in a single decode pass
+            dataset_dir, num_images = prepare_training_dataset(image_paths, output_dir)
             
             # Get training parameters
             lr = learning_rate or self.training_config.learning_rate
@@ -308,7 +295,7 @@ class SubjectCustomizationService:
             instance_prompt = get_instance_prompt()
             
             # Run training
-            logger.info("Starting LoRA training with {} images".format(len(valid_images)))
+            logger.info("Starting LoRA training with %s images", num_images)
             lora_path = await self._run_training(
                 dataset_dir=dataset_dir,
                 output_dir=output_dir,
@@ -325,12 +312,12 @@ class SubjectCustomizationService:
             
             # Upload LoRA to S3
             logger.info("Uploading LoRA to S3")
-            lora_s3_uri = s3_client.upload_lora(lora_path, lora_id)
+            lora_s3_uri = await asyncio.to_thread(s3_client.upload_lora, lora_path, lora_id)
             
             if not lora_s3_uri:
                 raise Exception("Failed to upload LoRA to S3")
             
-            logger.info("Successfully trained and uploaded LoRA: {}".format(lora_id))
+            logger.info("Successfully trained and uploaded LoRA: %s", lora_id)
             
             return {
                 "lora_id": lora_id,
@@ -340,7 +327,7 @@ class SubjectCustomizationService:
             }
             
         except Exception as e:
-            logger.error("LoRA training failed: {}".format(str(e)))
+            logger.error("LoRA training failed: %s", e)
             raise Exception("LoRA training failed: {}".format(str(e)))
         
         finally:
@@ -376,7 +363,7 @@ class SubjectCustomizationService:
             base_model = settings.model_path
             if settings.model_s3_path:
                 # If using S3 model, we need to download it first
-                model_path = s3_client.download_model_from_s3(settings.model_s3_path)
+                model_path = await asyncio.to_thread(s3_client.download_model_from_s3, settings.model_s3_path)
                 if model_path:
                     base_model = os.path.dirname(model_path)  # Use directory containing the model
             
@@ -425,21 +412,44 @@ class SubjectCustomizationService:
             if self.training_config.gradient_checkpointing:
                 cmd.append("--gradient_checkpointing")
             
-            logger.info("Running training command: {}".format(" ".join(cmd)))
-            
-            # Run training
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                cwd=output_dir
-            )
+            logger.info("Running training command: %s", " ".join(cmd))
+            
+            # Keep training off the inference GPU when a second one exists
+            train_gpu_id = self.training_config.train_gpu_id
+            share_gpu = train_gpu_id == 0 or torch.cuda.device_count() <= train_gpu_id
+            env = os.environ.copy()
+            if not share_gpu:
+                # Index into this process's visible devices, if already restricted
+                visible_devices = os.environ.get("CUDA_VISIBLE_DEVICES")
+                env["CUDA_VISIBLE_DEVICES"] = (
+                    visible_devices.split(",")[train_gpu_id] if visible_devices else str(train_gpu_id)
+                )
             
-            if result.returncode != 0:
-                logger.error("Training failed with return code: {}".format(result.returncode))
-                logger.error("STDOUT: {}".format(result.stdout))
-                logger.error("STDERR: {}".format(result.stderr))
-                raise Exception("Training process failed: {}".format(result.stderr))
+            if share_gpu:
+                # Pause inference for the run instead of contending for VRAM
+                logger.info("No dedicated training GPU, pausing inference during training")
+                await asyncio.to_thread(gpu_lock.acquire)
+            try:
+                # Run training without blocking the event loop
+                process = await asyncio.create_subprocess_exec(
+                    *cmd,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                    cwd=output_dir,
+                    env=env
+                )
+                stdout, stderr = await process.communicate()
+            finally:
+                if share_gpu:
+                    gpu_lock.release()
+            stdout = stdout.decode(errors="replace")
+            stderr = stderr.decode(errors="replace")
+            
+            if process.returncode != 0:
+                logger.error("Training failed with return code: %s", process.returncode)
+                logger.error("STDOUT: %s", stdout)
+                logger.error("STDERR: %s", stderr)
+                raise Exception("Training process failed: {}".format(stderr))
             
             # Find the generated LoRA file
             # Diffusers typically saves to output_dir/pytorch_lora_weights.safetensors
@@ -458,7 +468,7 @@ class SubjectCustomizationService:
                 raise Exception("LoRA file not found in output directory: {}".format(output_dir))
                 
         except Exception as e:
-            logger.error("Training execution failed: {}".format(str(e)))
+            logger.error("Training execution failed: %s", e)
             raise
     
     def _get_training_script_path(self) -> Optional[str]:
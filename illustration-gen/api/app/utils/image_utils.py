@@ -1,31 +1,50 @@
 import os
-import uuid
 import tempfile
 import logging
+import sys
+import threading
+import torch
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+from PIL import Image
+from diffusers.models.embeddings import ImageProjection
 from diffusers.utils import load_image
 from app.core.config import settings
+from app.core.training_config import training_config
+from app.core.prompt_embeddings import encode_batch_prompts
+from app.core.latent_cache import latent_cache, get_resume_pipeline, snapshot_steps
 
 logger = logging.getLogger(__name__)
 
-prompt_style_experiments = [
+# Local directory for saved images, served under /images
+IMAGE_DIR = os.path.join(tempfile.gettempdir(), "images")
+os.makedirs(IMAGE_DIR, exist_ok=True)
+
+_copy_stream = None
+
+# IP-Adapter references loaded from URLs/paths, keyed by URL
+_url_reference_cache = OrderedDict()
+_url_reference_cache_lock = threading.Lock()
+
+# Interned, immutable prompt tables. Duplicates of the original list were
+# dropped: old indices 4/5 are now 4 and 6/7 are now 5
+prompt_style_experiments = tuple(sys.intern(prompt) for prompt in (
     "high contrast, minimalistic, colored black and grungy white, stark, graphic novel illustration, cross hatching",
     "monochrome, bright highlights, deep shadows, graphic novel illustration",
     "monochrome, journal entry sketch, graphic novel illustration",
     "highest quality, monochrome, professional sketch, personal, intimate, nostalgic",
     "highest quality, monochrome, professional sketch, personal, nostalgic, clean",
-    "highest quality, monochrome, professional sketch, personal, nostalgic, clean",
     "highest quality, monochrome, professional sketch, clean, simple",
-    "highest quality, monochrome, professional sketch, clean, simple"
-]
+))
 
-subject_generation_prompt_experiments = [
-    "highest quality, professional sketch, monochrome"
-]
+subject_generation_prompt_experiments = tuple(sys.intern(prompt) for prompt in (
+    "highest quality, professional sketch, monochrome",
+))
 
-negative_prompt_experiments = [
+negative_prompt_experiments = tuple(sys.intern(prompt) for prompt in (
     "worst quality, low quality, error, glitch, mistake, busy, words, writing, photo, photo-realistic",
     "error, glitch, mistake",
-]
+))
 
 def prompt_builder(content_prompt: str, style_prompt: str, age: int = -1) -> str:
     """Build a complete prompt from content and style"""
@@ -33,9 +52,10 @@ def prompt_builder(content_prompt: str, style_prompt: str, age: int = -1) -> str
         return f"{content_prompt}, age {age}, {style_prompt}"
     return f"{content_prompt}, {style_prompt}"
 
-def subject_generation_inference(pipeline, num_inference_steps: int = None, reference_image_url: str = None, 
-                                ip_adapter_scale: float = None, negative_prompt: str = None, 
-                                style_prompt: str = None, adapter_name: str = None):
+def subject_generation_request(num_inference_steps: int = None, reference_image_url: str = None,
+                               ip_adapter_scale: float = None, negative_prompt: str = None,
+                               style_prompt: str = None, adapter_name: str = None) -> Dict[str, Any]:
+    """Build the inference request for a subject illustration"""
     # Use config defaults if not provided
     if num_inference_steps is None:
         num_inference_steps = settings.default_num_inference_steps
@@ -47,7 +67,6 @@ def subject_generation_inference(pipeline, num_inference_steps: int = None, refe
         style_prompt = settings.default_subject_style_prompt
     
     # If using LoRA, include instance token in prompt
-    from app.core.training_config import training_config
     if adapter_name:
         # Add instance token to prompt for LoRA
         instance_token = training_config.instance_token
@@ -55,13 +74,21 @@ def subject_generation_inference(pipeline, num_inference_steps: int = None, refe
     else:
         prompt_with_token = style_prompt
     
-    return inference(pipeline, prompt_with_token, num_inference_steps, reference_image_url, 
-                    ip_adapter_scale, negative_prompt, None, adapter_name)
+    return build_inference_request(prompt_with_token, num_inference_steps, reference_image_url, 
+                                   ip_adapter_scale, negative_prompt, None, adapter_name)
 
-def memory_generation_inference(pipeline, prompt: str, num_inference_steps: int = None, 
-                               reference_image_url: str = None, ip_adapter_scale: float = None, 
-                               negative_prompt: str = None, style_prompt: str = None,
-                               adapter_name: str = None):
+def subject_generation_inference(pipeline, num_inference_steps: int = None, reference_image_url: str = None, 
+                                ip_adapter_scale: float = None, negative_prompt: str = None, 
+                                style_prompt: str = None, adapter_name: str = None):
+    request = subject_generation_request(num_inference_steps, reference_image_url, ip_adapter_scale,
+                                         negative_prompt, style_prompt, adapter_name)
+    return batch_inference(pipeline, [request])[0]
+
+def memory_generation_request(prompt: str, num_inference_steps: int = None, 
+                              reference_image_url: str = None, ip_adapter_scale: float = None, 
+                              negative_prompt: str = None, style_prompt: str = None,
+                              adapter_name: str = None) -> Dict[str, Any]:
+    """Build the inference request for a memory illustration"""
     # Use config defaults if not provided
     if num_inference_steps is None:
         num_inference_steps = settings.default_num_inference_steps
@@ -73,7 +100,6 @@ def memory_generation_inference(pipeline, prompt: str, num_inference_steps: int
         style_prompt = settings.default_memory_style_prompt
     
     # If using LoRA, include instance token in prompt
-    from app.core.training_config import training_config
     if adapter_name:
         # Add instance token to prompt for LoRA
         instance_token = training_config.instance_token
@@ -81,19 +107,24 @@ def memory_generation_inference(pipeline, prompt: str, num_inference_steps: int
     else:
         augmented_prompt = prompt
     
-    return inference(pipeline, augmented_prompt, num_inference_steps, reference_image_url, 
-                    ip_adapter_scale, negative_prompt, style_prompt, adapter_name)
+    return build_inference_request(augmented_prompt, num_inference_steps, reference_image_url, 
+                                   ip_adapter_scale, negative_prompt, style_prompt, adapter_name)
 
-def inference(pipeline, prompt: str, num_inference_steps: int = None, reference_image_url: str = None, 
-              ip_adapter_scale: float = None, negative_prompt: str = None, style_prompt: str = "",
-              adapter_name: str = None):
-    """Run inference on the pipeline"""
-    print("prompt", prompt)
-    print("num_inference_steps", num_inference_steps)
-    print("reference_image_url", reference_image_url)
-    print("ip_adapter_scale", ip_adapter_scale)
-    print("negative_prompt", negative_prompt)
-    print("style_prompt", style_prompt)
+def memory_generation_inference(pipeline, prompt: str, num_inference_steps: int = None, 
+                               reference_image_url: str = None, ip_adapter_scale: float = None, 
+                               negative_prompt: str = None, style_prompt: str = None,
+                               adapter_name: str = None):
+    request = memory_generation_request(prompt, num_inference_steps, reference_image_url, ip_adapter_scale,
+                                        negative_prompt, style_prompt, adapter_name)
+    return batch_inference(pipeline, [request])[0]
+
+def build_inference_request(prompt: str, num_inference_steps: int = None, reference_image_url: str = None, 
+                            ip_adapter_scale: float = None, negative_prompt: str = None, style_prompt: str = "",
+                            adapter_name: str = None) -> Dict[str, Any]:
+    """Resolve the parameters of a single inference request"""
+    logger.debug("Inference request: prompt=%r steps=%s reference=%s scale=%s negative_prompt=%r style_prompt=%r",
+                 prompt, num_inference_steps, reference_image_url is not None, ip_adapter_scale,
+                 negative_prompt, style_prompt)
     
     # Use config defaults if not provided
     if num_inference_steps is None:
@@ -103,44 +134,271 @@ def inference(pipeline, prompt: str, num_inference_steps: int = None, reference_
     if negative_prompt is None:
         negative_prompt = settings.default_negative_prompt
 
-    # Prepare pipeline call kwargs
-    pipeline_kwargs = {
+    return {
         "prompt": prompt,
         "negative_prompt": negative_prompt,
-        "num_inference_steps": num_inference_steps
+        "num_inference_steps": num_inference_steps,
+        "reference_image": reference_image_url if settings.enable_ip_adapter else None,
+        "ip_adapter_scale": ip_adapter_scale,
+        "style_prompt": style_prompt,
+        "adapter_name": adapter_name,
+    }
+
+def batch_key(request: Dict[str, Any]) -> Tuple:
+    """
+    Key identifying requests that can share a single pipeline call.
+    Steps, LoRA adapter and IP-Adapter scale are pipeline-wide settings, and
+    diffusers applies one IP-Adapter reference to every prompt in a call.
+    """
+    reference = request["reference_image"]
+    use_ip_adapter = reference is not None
+    return (
+        request["num_inference_steps"],
+        request["adapter_name"],
+        use_ip_adapter,
+        request["ip_adapter_scale"] if use_ip_adapter else None,
+        _reference_identity(reference) if use_ip_adapter else None,
+    )
+
+def _reference_identity(reference) -> Any:
+    """
+    Identity of an IP-Adapter reference: the URL itself, or the object for
+    images and embeddings. Those come from the per-key, per-ETag reference
+    caches, so requests for the same unchanged object share one instance.
+    """
+    return reference if isinstance(reference, str) else id(reference)
+
+def encode_ip_adapter_image(pipeline, image) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Run the IP-Adapter image encoder once for a reference image.
+    
+    Returns:
+        (image_embeds, negative_image_embeds) on the CPU, in the layout
+        pipeline.encode_image produces for the loaded adapter
+    """
+    image_projection = pipeline.unet.encoder_hid_proj.image_projection_layers[0]
+    output_hidden_states = not isinstance(image_projection, ImageProjection)
+    pixel_values = pipeline.feature_extractor(image, return_tensors="pt").pixel_values
+    # Upload from pinned memory and encode on the side stream, so a new
+    # reference is encoded while the current batch keeps denoising
+    pixel_values, _ = _stage_on_gpu(pixel_values, pipeline.device)
+    with torch.inference_mode(), torch.cuda.stream(_get_copy_stream()):
+        image_embeds, negative_image_embeds = pipeline.encode_image(
+            pixel_values, pipeline.device, 1, output_hidden_states
+        )
+        return image_embeds.cpu(), negative_image_embeds.cpu()
+
+def load_reference(pipeline, url: str):
+    """
+    Load an IP-Adapter reference image from a URL or path, cached per URL.
+    
+    With an IP-Adapter image encoder loaded, the cached value is the encoded
+    (image_embeds, negative_image_embeds), so repeat requests skip the
+    download, decode and image encoder.
+    """
+    with _url_reference_cache_lock:
+        cached = _url_reference_cache.get(url)
+        if cached is not None:
+            _url_reference_cache.move_to_end(url)
+            return cached
+    
+    reference = load_image(url)
+    if getattr(pipeline, "image_encoder", None) is not None:
+        reference = encode_ip_adapter_image(pipeline, reference)
+    
+    with _url_reference_cache_lock:
+        _url_reference_cache[url] = reference
+        while len(_url_reference_cache) > settings.reference_image_cache_size:
+            _url_reference_cache.popitem(last=False)
+    return reference
+
+def _get_copy_stream():
+    """Side CUDA stream used to stage IP-Adapter inputs while the UNet runs"""
+    global _copy_stream
+    if _copy_stream is None:
+        _copy_stream = torch.cuda.Stream()
+    return _copy_stream
+
+def _stage_on_gpu(tensor: torch.Tensor, device) -> Tuple[torch.Tensor, Any]:
+    """
+    Copy a CPU tensor to the GPU from pinned memory on the side stream.
+    
+    Returns:
+        GPU tensor and the CUDA event recorded after the copy
+    """
+    pinned = tensor.pin_memory()
+    copy_stream = _get_copy_stream()
+    with torch.cuda.stream(copy_stream):
+        staged = pinned.to(device, non_blocking=True)
+        ready_event = torch.cuda.Event()
+        ready_event.record(copy_stream)
+    return staged, ready_event
+
+def prepare_batch(pipeline, requests: List[Dict[str, Any]]) -> Tuple[Dict[str, Any], Optional[Any]]:
+    """
+    Build pipeline kwargs for compatible requests (same batch_key).
+    
+    The batch shares one IP-Adapter reference (see batch_key). Its inputs
+    (precomputed or cached image embeddings, or preprocessed pixels for a PIL
+    reference) are copied to the GPU on a side stream once; diffusers tiles
+    them across the prompts.
+    This does not change pipeline state, so it can run while the previous
+    batch is still generating.
+    
+    Returns:
+        Pipeline kwargs and the CUDA event marking the end of the copy (or None)
+    """
+    first = requests[0]
+    ready_event = None
+
+    # Prepare pipeline call kwargs
+    pipeline_kwargs = {
+        "prompt": [request["prompt"] for request in requests],
+        "negative_prompt": [request["negative_prompt"] for request in requests],
+        "num_inference_steps": first["num_inference_steps"]
     }
     
     # Add LoRA adapter if specified
-    if adapter_name:
+    if first["adapter_name"]:
         pipeline_kwargs["cross_attention_kwargs"] = {"scale": 1.0}
         # Note: adapter_name is handled by diffusers when LoRA is loaded
     
-    if settings.enable_ip_adapter and reference_image_url:
-        # Use the provided reference image
-        ip_adapter_image = load_image(reference_image_url)
+    if first["reference_image"] is not None:
+        reference = first["reference_image"]
+        if isinstance(reference, str):
+            reference = load_reference(pipeline, reference)
+        if isinstance(reference, tuple):
+            # Precomputed embeddings skip the image encoder. diffusers expects
+            # [negative, positive] x [num_images, ...] for one adapter under CFG
+            positive, negative = reference
+            image_embeds, ready_event = _stage_on_gpu(torch.stack([negative, positive]), pipeline.device)
+            pipeline_kwargs["ip_adapter_image_embeds"] = [image_embeds]
+        else:
+            # PIL image: resize here rather than inside the pipeline call,
+            # so only the image encoder runs there
+            pixel_values = pipeline.feature_extractor(load_image(reference), return_tensors="pt").pixel_values
+            pixel_values, ready_event = _stage_on_gpu(pixel_values, pipeline.device)
+            pipeline_kwargs["ip_adapter_image"] = [pixel_values]
         
-        # Set IP adapter scale if different from default
-        if ip_adapter_scale != settings.default_ip_adapter_scale:
-            pipeline.set_ip_adapter_scale(ip_adapter_scale)
-        
-        pipeline_kwargs["prompt_2"] = style_prompt
-        pipeline_kwargs["ip_adapter_image"] = ip_adapter_image
+        # diffusers falls back to prompt when prompt_2 is unset
+        pipeline_kwargs["prompt_2"] = [request["style_prompt"] or request["prompt"] for request in requests]
+    
+    if settings.enable_latent_cache:
+        # Popped by run_batch before the pipeline call
+        pipeline_kwargs["latent_cache"] = latent_cache.lookup(pipeline, requests)
+    
+    return pipeline_kwargs, ready_event
+
+def set_ip_adapter_scale(pipeline, scale: float):
+    """
+    Set the IP-Adapter scale only when it differs from the one last set.
+    
+    load_ip_adapter leaves the scale at 1.0, so the first request always sets
+    it; after that, runs of requests with the same scale skip the update (and
+    the recompile it would trigger on a compiled UNet).
+    """
+    if getattr(pipeline, "_ip_adapter_scale", None) != scale:
+        pipeline.set_ip_adapter_scale(scale)
+        pipeline._ip_adapter_scale = scale
+
+def run_batch(pipeline, requests: List[Dict[str, Any]], pipeline_kwargs: Dict[str, Any],
+              ready_event: Optional[Any] = None) -> List:
+    """Run a batch prepared by prepare_batch as one pipeline call"""
+    first = requests[0]
+    
+    if first["reference_image"] is not None:
+        set_ip_adapter_scale(pipeline, first["ip_adapter_scale"])
+    
+    # Near-duplicate prompts continue from cached latents; full generations
+    # keep snapshots of theirs
+    lookup = pipeline_kwargs.pop("latent_cache", None)
+    recording = lookup is not None and lookup["denoising_start"] is None
+    record_steps = None  # Step count -> snapshot fraction, once timesteps are set
+    snapshots = {}
+    if lookup is not None and not recording:
+        pipeline_kwargs["image"] = lookup["latents"].to(pipeline.device)
+        pipeline_kwargs["denoising_start"] = lookup["denoising_start"]
+        pipeline = get_resume_pipeline(pipeline)
+    
+    # Report denoising progress to requests that asked for it (async jobs)
+    progress_callbacks = [request["on_step"] for request in requests if request.get("on_step")]
+    num_inference_steps = first["num_inference_steps"]
+    for on_step in progress_callbacks:
+        on_step(0, num_inference_steps)
+    
+    if progress_callbacks or recording:
+        def callback_on_step_end(pipe, step, timestep, callback_kwargs):
+            nonlocal record_steps
+            # Count the steps skipped by denoising_start too
+            step += len(pipe.scheduler.timesteps) - pipe.num_timesteps + 1
+            for on_step in progress_callbacks:
+                on_step(step, num_inference_steps)
+            if recording:
+                if record_steps is None:
+                    record_steps = snapshot_steps(pipe.scheduler)
+                fraction = record_steps.get(step)
+                if fraction is not None:
+                    snapshots[fraction] = callback_kwargs["latents"].cpu()
+            return callback_kwargs
         
-        return pipeline(**pipeline_kwargs).images[0]
-    else:
-        return pipeline(**pipeline_kwargs).images[0]
+        pipeline_kwargs["callback_on_step_end"] = callback_on_step_end
+    
+    if ready_event is not None:
+        # Wait for the staged IP-Adapter inputs and keep their memory alive
+        # until this stream is done with them
+        stream = torch.cuda.current_stream()
+        stream.wait_event(ready_event)
+        staged = pipeline_kwargs.get("ip_adapter_image_embeds") or pipeline_kwargs["ip_adapter_image"]
+        for tensor in staged:
+            tensor.record_stream(stream)
+    
+    with torch.inference_mode():
+        if settings.enable_prompt_embedding_cache:
+            # Encode prompts here so repeated style prompts come from the cache
+            pipeline_kwargs.update(encode_batch_prompts(
+                pipeline,
+                pipeline_kwargs.pop("prompt"),
+                pipeline_kwargs.pop("prompt_2", None),
+                pipeline_kwargs.pop("negative_prompt"),
+                first["adapter_name"]
+            ))
+        images = pipeline(**pipeline_kwargs, output_type="pt").images
+    
+    if recording:
+        latent_cache.store(requests, lookup["embeddings"], snapshots)
+    return tensors_to_pil(images)
+
+def tensors_to_pil(images: torch.Tensor) -> List[Image.Image]:
+    """
+    Convert a [B, 3, H, W] batch in [0, 1] to PIL images.
+    
+    The uint8 conversion runs on the GPU, so only a quarter of the bytes of
+    the float output cross to the CPU, in one copy for the whole batch.
+    """
+    images = images.mul(255).round_().clamp_(0, 255).to(torch.uint8)
+    images = images.permute(0, 2, 3, 1).contiguous().cpu().numpy()
+    return [Image.fromarray(image) for image in images]
+
+def batch_inference(pipeline, requests: List[Dict[str, Any]]) -> List:
+    """Run compatible inference requests (same batch_key) as one pipeline call"""
+    pipeline_kwargs, ready_event = prepare_batch(pipeline, requests)
+    return run_batch(pipeline, requests, pipeline_kwargs, ready_event)
+
+def inference(pipeline, prompt: str, num_inference_steps: int = None, reference_image_url: str = None, 
+              ip_adapter_scale: float = None, negative_prompt: str = None, style_prompt: str = "",
+              adapter_name: str = None):
+    """Run inference on the pipeline"""
+    request = build_inference_request(prompt, num_inference_steps, reference_image_url, ip_adapter_scale,
+                                      negative_prompt, style_prompt, adapter_name)
+    return batch_inference(pipeline, [request])[0]
 
 
 def save_image(image) -> str:
     """Save image to disk and return local file path"""
-    image_dir = os.path.join(tempfile.gettempdir(), "images")
-    if not os.path.exists(image_dir):
-        os.makedirs(image_dir)
-    
-    filename = "draw" + str(uuid.uuid4()).split("-")[0] + ".png"
-    image_path = os.path.join(image_dir, filename)
+    filename = "draw" + os.urandom(4).hex() + ".png"
+    image_path = os.path.join(IMAGE_DIR, filename)
     
-    logger.info("Saving image to {}".format(image_path))
-    image.save(image_path)
+    logger.info("Saving image to %s", image_path)
+    image.save(image_path, compress_level=settings.png_compress_level)
     
     return image_path  # Return local file path, not URL
\ No newline at end of file
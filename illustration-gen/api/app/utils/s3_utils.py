@@ -1,190 +1,399 @@
 import boto3
+import fcntl
+from boto3.s3.transfer import BaseSubscriber, ProgressCallbackInvoker, TransferConfig, create_transfer_manager
+from botocore.config import Config
 import logging
-import uuid
 import tempfile
 import os
 import time
 import io
-from typing import Optional, List, Tuple
+import mmap
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from typing import Iterator, Optional, List, Tuple
 from botocore.exceptions import ClientError, NoCredentialsError
 from app.core.config import settings
 
 logger = logging.getLogger(__name__)
 
+SIZE_UNITS = ("B", "KB", "MB", "GB", "TB")
+SIZE_DIVISORS = tuple(1 << (10 * i) for i in range(len(SIZE_UNITS)))
+# Lowercase image extensions accepted for training sets
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+
+class _ProvideObjectMeta(BaseSubscriber):
+    """
+    Hand the transfer manager a size (and ETag) we already have so it skips its
+    own HEAD. The CRT transfer manager sizes transfers natively and ignores this.
+    """
+    
+    def __init__(self, size: int, etag: Optional[str]):
+        self._size = size
+        self._etag = etag
+    
+    def on_queued(self, future, **kwargs):
+        if not hasattr(future.meta, 'provide_transfer_size'):
+            return
+        future.meta.provide_transfer_size(self._size)
+        if self._etag and hasattr(future.meta, 'provide_object_etag'):
+            future.meta.provide_object_etag(self._etag)
+
+
+@contextmanager
+def _cache_lock(cache_path: str):
+    """Exclusive lock on a cache entry, shared across worker processes"""
+    with open(cache_path + ".lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
 
 class S3Client:
     def __init__(self):
         self.s3_client = None
-        self._last_progress_time = 0
-        self._progress_interval = 10  # Log every 5 seconds
+        # Map (bucket, key) -> (checked_at, local_path) of objects in the local cache
+        self._validated = {}
+        self._validated_lock = threading.Lock()
+        # The cache directory is created once here instead of on every download
+        try:
+            os.makedirs(settings.cache_dir, exist_ok=True)
+        except OSError as e:
+            raise RuntimeError(
+                f"Cannot create cache directory {settings.cache_dir} (set CACHE_DIR to a writable path): {e}"
+            ) from e
+        self._progress_interval = 10  # Log download progress every 10 seconds
+        self._progress_check_bytes = 8 * 1024 * 1024  # Only look at the clock every 8 MiB
+        # Parallel ranged GETs for large objects (models, LoRAs). Small hosts
+        # (few cores, usually little bandwidth) get fewer transfer threads
+        self._transfer_config = TransferConfig(
+            multipart_threshold=settings.s3_multipart_threshold,
+            multipart_chunksize=settings.s3_multipart_chunksize,
+            max_concurrency=max(1, min(settings.s3_max_concurrency, (os.cpu_count() or 1) * 4)),
+            io_chunksize=settings.s3_io_chunksize,
+            use_threads=True,
+            preferred_transfer_client=settings.s3_transfer_client
+        )
         self._initialize_client()
     
     def _initialize_client(self):
         """Initialize S3 client with credentials"""
         try:
+            # One client for the process: the connection pool must fit all
+            # concurrent transfer and I/O threads so TLS connections get reused
+            client_config = Config(
+                max_pool_connections=max(
+                    settings.s3_max_pool_connections, settings.s3_max_concurrency, settings.io_workers
+                ),
+                tcp_keepalive=True,
+                connect_timeout=settings.s3_connect_timeout,
+                read_timeout=settings.s3_read_timeout,
+                retries={'max_attempts': 5, 'mode': 'adaptive'}
+            )
             if settings.aws_access_key_id and settings.aws_secret_access_key:
-                self.s3_client = boto3.client(
-                    's3',
+                session = boto3.session.Session(
                     aws_access_key_id=settings.aws_access_key_id,
                     aws_secret_access_key=settings.aws_secret_access_key,
                     region_name=settings.aws_region
                 )
             else:
                 # Use default credentials (IAM role, environment variables, etc.)
-                self.s3_client = boto3.client('s3', region_name=settings.aws_region)
+                session = boto3.session.Session(region_name=settings.aws_region)
+            self.s3_client = session.client('s3', config=client_config)
             logger.info("S3 client initialized successfully")
         except NoCredentialsError:
             logger.error("AWS credentials not found")
             raise Exception("AWS credentials not configured")
         except Exception as e:
-            logger.error("Failed to initialize S3 client: {}".format(str(e)))
-            raise Exception("Failed to initialize S3 client: {}".format(str(e)))
+            logger.error("Failed to initialize S3 client: %s", e)
+            raise Exception(f"Failed to initialize S3 client: {e}")
     
     def _format_size(self, size_bytes: int) -> str:
         """Format file size in human readable format"""
         if size_bytes == 0:
             return "0B"
-        size_names = ["B", "KB", "MB", "GB", "TB"]
-        import math
-        i = int(math.floor(math.log(size_bytes, 1024)))
-        p = math.pow(1024, i)
-        s = round(size_bytes / p, 2)
-        return f"{s} {size_names[i]}"
+        # Unit index from the bit length: every 10 bits is a factor of 1024
+        i = min((size_bytes.bit_length() - 1) // 10, len(SIZE_UNITS) - 1)
+        return f"{round(size_bytes / SIZE_DIVISORS[i], 2)} {SIZE_UNITS[i]}"
     
-    def _progress_callback(self, bytes_transferred: int, total_size: int):
-        """Progress callback for S3 download - logs every 5 seconds"""
-        current_time = time.time()
+    def _make_progress_callback(self, total_size: int):
+        """
+        Progress callback for one S3 download, logging every _progress_interval seconds.
+        
+        boto3 calls it from every transfer thread with the bytes of each read, so
+        it keeps a running total under a lock and only checks the clock once
+        every _progress_check_bytes.
+        """
+        lock = threading.Lock()
+        state = {"transferred": 0, "unchecked": 0, "last_log": time.monotonic()}
         
-        # Only log if 5 seconds have passed since last log
-        if current_time - self._last_progress_time >= self._progress_interval:
+        def callback(bytes_amount: int):
+            with lock:
+                state["transferred"] += bytes_amount
+                state["unchecked"] += bytes_amount
+                if state["unchecked"] < self._progress_check_bytes:
+                    return
+                state["unchecked"] = 0
+                now = time.monotonic()
+                if now - state["last_log"] < self._progress_interval:
+                    return
+                state["last_log"] = now
+                transferred = state["transferred"]
+            
             if total_size > 0:
-                percentage = (bytes_transferred / total_size) * 100
-                transferred_str = self._format_size(bytes_transferred)
-                total_str = self._format_size(total_size)
-                logger.info(f"Download progress: {percentage:.1f}% ({transferred_str}/{total_str})")
+                logger.info("Download progress: %.1f%% (%s/%s)", transferred / total_size * 100,
+                            self._format_size(transferred), self._format_size(total_size))
+        
+        return callback
+    
+    def _part_config(self, size: int) -> TransferConfig:
+        """
+        Transfer config for one object of known size, with parts small enough
+        to keep every transfer thread busy (but no smaller than the multipart
+        threshold).
+        """
+        concurrency = self._transfer_config.max_concurrency
+        chunksize = max(settings.s3_multipart_threshold, -(-size // concurrency))
+        if chunksize >= self._transfer_config.multipart_chunksize:
+            return self._transfer_config
+        return TransferConfig(
+            multipart_threshold=settings.s3_multipart_threshold,
+            multipart_chunksize=chunksize,
+            max_concurrency=concurrency,
+            io_chunksize=settings.s3_io_chunksize,
+            use_threads=True,
+            preferred_transfer_client=settings.s3_transfer_client
+        )
+    
+    def _download_object(self, bucket: str, key: str, local_path: str, size: Optional[int] = None,
+                         etag: Optional[str] = None, callback=None):
+        """
+        Download an S3 object to a local path.
+        
+        Objects below the multipart threshold (or of unknown size) are a single
+        GET streamed to disk in io_chunksize writes; larger ones go through the
+        transfer manager's parallel ranged GETs.
+        """
+        if size is not None and size >= settings.s3_multipart_threshold:
+            # download_file would HEAD the object again for its size
+            subscribers = [_ProvideObjectMeta(size, etag)]
+            if callback:
+                subscribers.append(ProgressCallbackInvoker(callback))
+            with create_transfer_manager(self.s3_client, self._transfer_config) as manager:
+                manager.download(bucket, key, local_path, subscribers=subscribers).result()
+            return
+        
+        response = self.s3_client.get_object(Bucket=bucket, Key=key)
+        with open(local_path, 'wb') as f:
+            shutil.copyfileobj(response['Body'], f, length=settings.s3_io_chunksize)
+    
+    def _download_to_cache(self, bucket: str, key: str, suffix: str, show_progress: bool = False) -> str:
+        """
+        Download an S3 object into the content-addressed local cache.
+        Files are keyed by ETag, so unchanged objects are never downloaded twice
+        and updated objects get a fresh cache entry.
+        
+        Objects validated within cache_revalidate_seconds are returned without
+        another HEAD.
+        
+        Returns:
+            Local file path of the cached object
+        """
+        with self._validated_lock:
+            validated = self._validated.get((bucket, key))
+        if validated and time.monotonic() - validated[0] < settings.cache_revalidate_seconds \
+                and os.path.exists(validated[1]):
+            logger.debug("Using recently validated copy of s3://%s/%s: %s", bucket, key, validated[1])
+            return validated[1]
+        
+        # The only HEAD for this object: it supplies the cache key, and its
+        # size and ETag are passed on to the download
+        response = self.s3_client.head_object(Bucket=bucket, Key=key)
+        etag = response['ETag'].strip('"')
+        file_size = response['ContentLength']
+        
+        local_path = os.path.join(settings.cache_dir, f"{etag}{suffix}")
+        
+        # Check if object is already cached locally
+        if os.path.exists(local_path):
+            logger.info("Using cached copy of s3://%s/%s: %s (%s)", bucket, key, local_path, self._format_size(file_size))
+            self._mark_validated(bucket, key, local_path)
+            return local_path
+        
+        logger.info("Starting download from S3: s3://%s/%s (%s)", bucket, key, self._format_size(file_size))
+        callback = self._make_progress_callback(file_size) if show_progress else None
+        
+        # Other workers fetching the same object wait here, then find it cached
+        with _cache_lock(local_path):
+            if os.path.exists(local_path):
+                logger.info("Using copy of s3://%s/%s downloaded by another worker: %s", bucket, key, local_path)
+                self._mark_validated(bucket, key, local_path)
+                return local_path
             
-            self._last_progress_time = current_time
+            # Download to a temp file in the cache dir and rename atomically so an
+            # interrupted download never leaves a partial file at the cache path
+            fd, temp_path = tempfile.mkstemp(dir=settings.cache_dir, suffix=".part")
+            os.close(fd)
+            try:
+                self._download_object(bucket, key, temp_path, file_size, response['ETag'], callback)
+                os.replace(temp_path, local_path)
+            finally:
+                if os.path.exists(temp_path):
+                    os.unlink(temp_path)
+        
+        self._mark_validated(bucket, key, local_path)
+        return local_path
+    
+    def _mark_validated(self, bucket: str, key: str, local_path: str):
+        """Record that local_path matched the object's current ETag just now"""
+        with self._validated_lock:
+            self._validated[(bucket, key)] = (time.monotonic(), local_path)
+    
+    def _add_to_cache(self, bucket: str, key: str, local_path: str, suffix: str):
+        """Move a just-uploaded file into the local cache under the object's ETag"""
+        etag = self.s3_client.head_object(Bucket=bucket, Key=key)['ETag'].strip('"')
+        cache_path = os.path.join(settings.cache_dir, f"{etag}{suffix}")
+        if not os.path.exists(cache_path):
+            fd, temp_path = tempfile.mkstemp(dir=settings.cache_dir, suffix=".part")
+            os.close(fd)
+            try:
+                shutil.move(local_path, temp_path)
+                os.replace(temp_path, cache_path)
+            finally:
+                if os.path.exists(temp_path):
+                    os.unlink(temp_path)
+        self._mark_validated(bucket, key, cache_path)
     
     def download_model_from_s3(self, s3_path: str) -> Optional[str]:
-        """Download model from S3 and return local file path"""
+        """Download model from S3 (or reuse the cached copy) and return local file path"""
         try:
-            # Reset progress timer for new download
-            self._last_progress_time = 0
-            
             # Parse S3 path
             if not s3_path.startswith('s3://'):
                 raise ValueError("S3 path must start with 's3://'")
             
             # Extract bucket and key
-            s3_path = s3_path[5:]  # Remove 's3://'
-            bucket, key = s3_path.split('/', 1)
-            
-            # Create local temp file
-            local_path = os.path.join(tempfile.gettempdir(), f"model_{os.path.basename(key)}")
-            
-            # Check if file already exists locally
-            if os.path.exists(local_path):
-                file_size = os.path.getsize(local_path)
-                size_str = self._format_size(file_size)
-                logger.info(f"Model already exists locally: {local_path} ({size_str})")
-                return local_path
-            
-            # Get file size from S3
-            logger.info(f"Checking model size in S3: {s3_path}")
-            response = self.s3_client.head_object(Bucket=bucket, Key=key)
-            file_size = response['ContentLength']
-            size_str = self._format_size(file_size)
-            logger.info(f"Model size: {size_str}")
+            bucket, key = s3_path[5:].split('/', 1)
+            _, ext = os.path.splitext(key)
             
-            # Download from S3 with progress
-            logger.info(f"Starting download from S3: {s3_path}")
-            self.s3_client.download_file(
-                bucket, 
-                key, 
-                local_path,
-                Callback=lambda bytes_transferred: self._progress_callback(bytes_transferred, file_size)
-            )
+            local_path = self._download_to_cache(bucket, key, ext, show_progress=True)
             
             # Verify download
-            downloaded_size = os.path.getsize(local_path)
-            downloaded_str = self._format_size(downloaded_size)
-            logger.info(f"✅ Successfully downloaded model: {s3_path} -> {local_path}")
-            logger.info(f"Downloaded size: {downloaded_str}")
+            downloaded_str = self._format_size(os.path.getsize(local_path))
+            logger.info("✅ Model ready: %s -> %s (%s)", s3_path, local_path, downloaded_str)
             
             return local_path
             
         except ClientError as e:
-            logger.error(f"Failed to download model from S3: {e}")
+            logger.error("Failed to download model from S3: %s", e)
             return None
         except Exception as e:
-            logger.error(f"Error downloading model: {e}")
+            logger.error("Error downloading model: %s", e)
             return None
     
     def upload_image_from_memory(self, image, s3_key: str) -> Optional[str]:
-        """Upload PIL image to S3 using temporary file"""
-        temp_file = None
+        """Encode a PIL image to PNG in memory and upload it to S3"""
         try:
-            # Create temporary file
-            temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.png')
-            temp_path = temp_file.name
-            temp_file.close()
-            
-            # Save PIL image to temporary file
-            image.save(temp_path, format='PNG')
-            
-            # Upload file to S3
-            self.s3_client.upload_file(temp_path, settings.s3_bucket_name, s3_key)
+            buffer = io.BytesIO()
+            # zlib dominates PNG encode time; low levels are much faster for a
+            # small size increase. optimize would add extra compression passes.
+            image.save(buffer, format='PNG', compress_level=settings.png_compress_level, optimize=False)
+            buffer.seek(0)
+            
+            # Upload straight from the buffer, no temp file or bytes copy
+            self.s3_client.put_object(
+                Bucket=settings.s3_bucket_name,
+                Key=s3_key,
+                Body=buffer,
+                ContentType='image/png'
+            )
             
             # Generate S3 URI
             s3_uri = "s3://{}/{}".format(settings.s3_bucket_name, s3_key)
-            logger.info("Uploaded image to S3: {}".format(s3_uri))
+            logger.info("Uploaded image to S3: %s", s3_uri)
             
             return s3_uri
             
         except Exception as e:
-            logger.error("Failed to upload image to S3: {}".format(str(e)))
+            logger.error("Failed to upload image to S3: %s", e)
             return None
-        finally:
-            # Clean up temporary file
-            if temp_file and os.path.exists(temp_path):
-                os.unlink(temp_path)
     
-    def download_image(self, key: str) -> Optional[str]:
-        """Download image from S3 and return local file path"""
+    def _get_if_changed(self, key: str, etag: Optional[str]) -> Optional[dict]:
+        """
+        GET an object in the default bucket, conditional on its ETag.
+        
+        Returns:
+            The get_object response, or None if the object still has this ETag
+        """
         try:
-            # Create a temporary file path
-            temp_file = tempfile.NamedTemporaryFile(delete=False, suffix='.png')
-            temp_path = temp_file.name
-            temp_file.close()
-            
-            # Download from S3
-            self.s3_client.download_file(settings.s3_bucket_name, key, temp_path)
-            logger.info("Downloaded image from S3: {}".format(key))
-            return temp_path
+            if etag:
+                return self.s3_client.get_object(
+                    Bucket=settings.s3_bucket_name, Key=key, IfNoneMatch='"{}"'.format(etag)
+                )
+            return self.s3_client.get_object(Bucket=settings.s3_bucket_name, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('304', 'NotModified'):
+                return None
+            raise
+    
+    def _read_body(self, response: dict) -> bytearray:
+        """Read a get_object body straight into a buffer sized from Content-Length"""
+        body = response['Body']
+        data = bytearray(response['ContentLength'])
+        view = memoryview(data)
+        offset = 0
+        while offset < len(data):
+            chunk = body.read(len(data) - offset)
+            if not chunk:
+                raise Exception(f"Connection closed after {offset} of {len(data)} bytes")
+            view[offset:offset + len(chunk)] = chunk
+            offset += len(chunk)
+        return data
+    
+    def download_image_bytes_if_changed(self, key: str, etag: Optional[str]) -> Tuple[Optional[str], Optional[bytearray]]:
+        """
+        Download an image into memory unless it still has the given ETag.
+        
+        Returns:
+            (etag, data): data is None if the object is unchanged, and both are
+            None if the download failed or the object does not exist
+        """
+        try:
+            response = self._get_if_changed(key, etag)
+            if response is None:
+                return etag, None
+            data = self._read_body(response)
+            logger.info("Downloaded image from S3: %s", key)
+            return response['ETag'].strip('"'), data
             
         except ClientError as e:
-            logger.error("Failed to download image from S3: {}".format(str(e)))
-            return None
+            logger.error("Failed to download image from S3: %s", e)
+            return None, None
         except Exception as e:
-            logger.error("Unexpected error downloading image: {}".format(str(e)))
-            return None
+            logger.error("Unexpected error downloading image: %s", e)
+            return None, None
     
     def upload_image(self, local_file_path: str, s3_key: str) -> Optional[str]:
         """Upload image to S3 and return S3 URI"""
         try:
             # Upload to S3
-            self.s3_client.upload_file(local_file_path, settings.s3_bucket_name, s3_key)
+            self.s3_client.upload_file(
+                local_file_path, settings.s3_bucket_name, s3_key, Config=self._transfer_config
+            )
             
             # Generate S3 URI
             s3_uri = "s3://{}/{}".format(settings.s3_bucket_name, s3_key)
-            logger.info("Uploaded image to S3: {}".format(s3_uri))
+            logger.info("Uploaded image to S3: %s", s3_uri)
             return s3_uri
             
         except ClientError as e:
-            logger.error("Failed to upload image to S3: {}".format(str(e)))
+            logger.error("Failed to upload image to S3: %s", e)
             return None
         except Exception as e:
-            logger.error("Unexpected error uploading image: {}".format(str(e)))
+            logger.error("Unexpected error uploading image: %s", e)
             return None
     
     def get_avatar_key(self, user_id: str) -> str:
@@ -197,7 +406,7 @@ class S3Client:
     
     def get_generated_key(self, user_id: str, illustration_type: str) -> str:
         """Generate S3 key for generated illustration"""
-        unique_id = str(uuid.uuid4())[:8]
+        unique_id = os.urandom(4).hex()
         return "{}{}/{}_{}.png".format(
             settings.s3_generated_prefix, 
             user_id, 
@@ -213,50 +422,49 @@ class S3Client:
         """Upload LoRA weights to S3 and return S3 URI"""
         try:
             lora_key = self.get_lora_key(lora_id)
-            self.s3_client.upload_file(local_path, settings.s3_bucket_name, lora_key)
+            # Stream from a read-only mapping of the training output in parallel
+            # parts. LoRAs are tens to hundreds of MB, so the 64 MiB parts used
+            # for checkpoints would leave most upload threads idle
+            with open(local_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as weights:
+                self.s3_client.upload_fileobj(
+                    weights, settings.s3_bucket_name, lora_key, Config=self._part_config(len(weights))
+                )
             
             s3_uri = "s3://{}/{}".format(settings.s3_bucket_name, lora_key)
-            logger.info("Uploaded LoRA to S3: {}".format(s3_uri))
+            logger.info("Uploaded LoRA to S3: %s", s3_uri)
+            
+            # Seed the download cache so the first generation with this LoRA
+            # does not fetch it back from S3
+            try:
+                self._add_to_cache(settings.s3_bucket_name, lora_key, local_path, ".safetensors")
+            except Exception as e:
+                logger.warning("Could not cache uploaded LoRA: %s", e)
+            
             return s3_uri
             
         except ClientError as e:
-            logger.error("Failed to upload LoRA to S3: {}".format(str(e)))
+            logger.error("Failed to upload LoRA to S3: %s", e)
             return None
         except Exception as e:
-            logger.error("Unexpected error uploading LoRA: {}".format(str(e)))
+            logger.error("Unexpected error uploading LoRA: %s", e)
             return None
     
     def download_lora(self, lora_id: str) -> Optional[str]:
         """Download LoRA weights from S3 with local caching"""
         try:
             lora_key = self.get_lora_key(lora_id)
-            
-            # Create local cache directory
-            cache_dir = os.path.join(tempfile.gettempdir(), "lora_cache")
-            if not os.path.exists(cache_dir):
-                os.makedirs(cache_dir)
-            
-            # Use lora_id as filename for caching
-            local_path = os.path.join(cache_dir, "{}.safetensors".format(lora_id))
-            
-            # Check if already cached
-            if os.path.exists(local_path):
-                logger.info("LoRA already cached locally: {}".format(local_path))
-                return local_path
-            
-            # Download from S3
-            self.s3_client.download_file(settings.s3_bucket_name, lora_key, local_path)
-            logger.info("Downloaded LoRA from S3: {}".format(lora_key))
+            local_path = self._download_to_cache(settings.s3_bucket_name, lora_key, ".safetensors")
+            logger.info("LoRA %s ready at %s", lora_id, local_path)
             return local_path
             
         except ClientError as e:
             if e.response['Error']['Code'] == '404':
-                logger.error("LoRA not found in S3: {}".format(lora_id))
+                logger.error("LoRA not found in S3: %s", lora_id)
             else:
-                logger.error("Failed to download LoRA from S3: {}".format(str(e)))
+                logger.error("Failed to download LoRA from S3: %s", e)
             return None
         except Exception as e:
-            logger.error("Unexpected error downloading LoRA: {}".format(str(e)))
+            logger.error("Unexpected error downloading LoRA: %s", e)
             return None
     
     def _parse_s3_path(self, s3_path_or_prefix: str) -> Tuple[str, str]:
@@ -274,66 +482,76 @@ class S3Client:
         
         return bucket, key
     
+    def _iter_image_keys(self, bucket: str, prefix: str) -> Iterator[str]:
+        """Yield image keys under a prefix as each listing page arrives"""
+        # List objects with prefix
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        pages = paginator.paginate(Bucket=bucket, Prefix=prefix, PaginationConfig={'PageSize': 1000})
+        for page in pages:
+            for obj in page.get('Contents', []):
+                key = obj['Key']
+                # Check if it's an image file
+                if key.lower().endswith(IMAGE_EXTENSIONS):
+                    yield key
+    
     def list_images_in_s3_path(self, s3_path_or_prefix: str) -> List[str]:
         """List all image files in S3 path/prefix"""
         try:
             bucket, prefix = self._parse_s3_path(s3_path_or_prefix)
+            image_keys = list(self._iter_image_keys(bucket, prefix))
             
-            # Image extensions to filter
-            image_extensions = {'.png', '.jpg', '.jpeg', '.PNG', '.JPG', '.JPEG'}
-            
-            # List objects with prefix
-            paginator = self.s3_client.get_paginator('list_objects_v2')
-            image_keys = []
-            
-            for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
-                if 'Contents' in page:
-                    for obj in page['Contents']:
-                        key = obj['Key']
-                        # Check if it's an image file
-                        if any(key.lower().endswith(ext.lower()) for ext in image_extensions):
-                            image_keys.append(key)
-            
-            logger.info("Found {} images in S3 path: {}".format(len(image_keys), s3_path_or_prefix))
+            logger.info("Found %s images in S3 path: %s", len(image_keys), s3_path_or_prefix)
             return image_keys
             
         except ClientError as e:
-            logger.error("Failed to list images in S3 path: {}".format(str(e)))
+            logger.error("Failed to list images in S3 path: %s", e)
             return []
         except Exception as e:
-            logger.error("Unexpected error listing images: {}".format(str(e)))
+            logger.error("Unexpected error listing images: %s", e)
             return []
     
     def download_images_from_s3_path(self, s3_path_or_prefix: str) -> List[str]:
         """Download all images from S3 path/prefix to local temp directory"""
         try:
-            image_keys = self.list_images_in_s3_path(s3_path_or_prefix)
-            
-            if not image_keys:
-                logger.warning("No images found in S3 path: {}".format(s3_path_or_prefix))
-                return []
-            
-            bucket, _ = self._parse_s3_path(s3_path_or_prefix)
+            bucket, prefix = self._parse_s3_path(s3_path_or_prefix)
             
             # Create temp directory for downloaded images
             temp_dir = tempfile.mkdtemp(prefix="training_images_")
-            local_paths = []
             
-            for key in image_keys:
-                # Create local filename
-                filename = os.path.basename(key)
+            def download(i: int, key: str) -> str:
+                # Prefix with the index so same-named objects under different
+                # prefixes do not overwrite each other
+                filename = "{:04d}_{}".format(i, os.path.basename(key))
                 local_path = os.path.join(temp_dir, filename)
-                
-                # Download image
-                self.s3_client.download_file(bucket, key, local_path)
-                local_paths.append(local_path)
-                logger.debug("Downloaded image: {} -> {}".format(key, local_path))
+                self._download_object(bucket, key, local_path)
+                logger.debug("Downloaded image: %s -> %s", key, local_path)
+                return local_path
+            
+            # Small objects: fetch many at once instead of paying one RTT after
+            # another, starting on each listing page as soon as it arrives
+            with ThreadPoolExecutor(max_workers=settings.s3_max_concurrency) as executor:
+                futures = [
+                    executor.submit(download, i, key)
+                    for i, key in enumerate(self._iter_image_keys(bucket, prefix))
+                ]
+                for future in as_completed(futures):
+                    if future.exception() is not None:
+                        # Don't start the rest of the set once one image has failed
+                        for pending in futures:
+                            pending.cancel()
+                        raise future.exception()
+                local_paths = [future.result() for future in futures]
+            
+            if not local_paths:
+                logger.warning("No images found in S3 path: %s", s3_path_or_prefix)
+                shutil.rmtree(temp_dir, ignore_errors=True)
+                return []
             
-            logger.info("Downloaded {} images to {}".format(len(local_paths), temp_dir))
+            logger.info("Downloaded %s images to %s", len(local_paths), temp_dir)
             return local_paths
             
         except Exception as e:
-            logger.error("Failed to download images from S3 path: {}".format(str(e)))
+            logger.error("Failed to download images from S3 path: %s", e)
             return []
 
 
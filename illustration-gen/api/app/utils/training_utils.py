@@ -1,57 +1,66 @@
 import os
 import logging
-from typing import List, Optional
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
 from PIL import Image
 from app.core.training_config import training_config
 
 logger = logging.getLogger(__name__)
 
 
-def validate_images(image_paths: List[str]) -> List[str]:
-    """Validate that image files exist and are valid images"""
-    valid_images = []
-    
-    for image_path in image_paths:
-        try:
-            with Image.open(image_path) as img:
-                img.verify()  # Verify it's a valid image
-            valid_images.append(image_path)
-            logger.debug("Validated image: {}".format(image_path))
-        except Exception as e:
-            logger.warning("Invalid image file {}: {}".format(image_path, str(e)))
-    
-    if not valid_images:
-        raise ValueError("No valid images found in provided paths")
-    
-    logger.info("Validated {} out of {} images".format(len(valid_images), len(image_paths)))
-    return valid_images
+def _link_or_copy(src: str, dst: str):
+    """Hard-link src to dst, copying instead across filesystems"""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
 
 
-def prepare_training_dataset(image_paths: List[str], output_dir: str) -> str:
+def prepare_training_dataset(image_paths: List[str], output_dir: str) -> Tuple[str, int]:
     """
-    Prepare training dataset directory structure.
-    Returns the path to the dataset directory.
+    Validate training images and write them into the dataset directory in one pass.
+    
+    Images are decoded in parallel, each once: a failed decode marks it invalid. Valid files
+    whose contents already match their extension are hard-linked into the
+    dataset (copied if that fails); only mislabelled ones are re-encoded from
+    the decoded image.
+    
+    Returns:
+        The dataset directory and the number of valid images written
     """
     # Create dataset directory
     dataset_dir = os.path.join(output_dir, "dataset")
     os.makedirs(dataset_dir, exist_ok=True)
     
-    # Copy images to dataset directory
-    for i, image_path in enumerate(image_paths):
-        # Get file extension
-        _, ext = os.path.splitext(image_path)
-        # Create new filename
-        new_filename = "{:04d}{}".format(i, ext)
-        new_path = os.path.join(dataset_dir, new_filename)
-        
-        # Copy image
-        with Image.open(image_path) as img:
-            img.save(new_path)
-        
-        logger.debug("Copied image: {} -> {}".format(image_path, new_path))
+    def add_image(indexed_path: Tuple[int, str]) -> bool:
+        i, image_path = indexed_path
+        try:
+            with Image.open(image_path) as img:
+                img.load()  # Full decode; raises on corrupt or truncated files
+                
+                # Numbered by input position, so workers never race for a name
+                _, ext = os.path.splitext(image_path)
+                new_path = os.path.join(dataset_dir, "{:04d}{}".format(i, ext))
+                if Image.registered_extensions().get(ext.lower()) == img.format:
+                    _link_or_copy(image_path, new_path)
+                else:
+                    img.save(new_path)
+            logger.debug("Copied image: %s -> %s", image_path, new_path)
+            return True
+        except Exception as e:
+            logger.warning("Invalid image file %s: %s", image_path, e)
+            return False
+    
+    # Pillow releases the GIL while decoding, so threads decode in parallel
+    with ThreadPoolExecutor(max_workers=min(32, os.cpu_count() or 1)) as executor:
+        num_valid = sum(executor.map(add_image, enumerate(image_paths)))
+    
+    if not num_valid:
+        raise ValueError("No valid images found in provided paths")
     
-    logger.info("Prepared dataset with {} images in {}".format(len(image_paths), dataset_dir))
-    return dataset_dir
+    logger.info("Prepared dataset with %s out of %s images in %s", num_valid, len(image_paths), dataset_dir)
+    return dataset_dir, num_valid
 
 
 def get_instance_prompt() -> str:
@@ -63,24 +72,19 @@ def create_training_output_dir(lora_id: str) -> str:
     """Create output directory for LoRA training"""
     output_dir = os.path.join(training_config.output_dir, lora_id)
     os.makedirs(output_dir, exist_ok=True)
-    logger.info("Created training output directory: {}".format(output_dir))
+    logger.info("Created training output directory: %s", output_dir)
     return output_dir
 
 
 def cleanup_temp_files(*paths: str):
     """Clean up temporary files and directories"""
-    import shutil
-    
     for path in paths:
         try:
             if os.path.isfile(path):
                 os.unlink(path)
-                logger.debug("Removed file: {}".format(path))
+                logger.debug("Removed file: %s", path)
             elif os.path.isdir(path):
                 shutil.rmtree(path)
-                logger.debug("Removed directory: {}".format(path))
+                logger.debug("Removed directory: %s", path)
         except Exception as e:
-            logger.warning("Failed to remove {}: {}".format(path, str(e)))
-
-
-
+            logger.warning("Failed to remove %s: %s", path, e)
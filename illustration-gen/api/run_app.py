@@ -2,15 +2,37 @@
 """
 Run the refactored FastAPI application
 """
+import logging
 import uvicorn
 from app.main import app
 from app.core.config import settings
 
+logger = logging.getLogger(__name__)
+
+
+def get_worker_count() -> int:
+    """Cap the worker count so every worker can hold the model in GPU memory"""
+    workers = settings.uvicorn_workers
+    if workers > 1:
+        import torch
+        if torch.cuda.is_available():
+            gpu_memory_gb = torch.cuda.get_device_properties(0).total_memory / 1024 ** 3
+            max_workers = max(1, int(gpu_memory_gb // settings.worker_gpu_memory_gb))
+            if workers > max_workers:
+                logger.warning("Reducing workers from %s to %s to fit %.1f GB of GPU memory",
+                               workers, max_workers, gpu_memory_gb)
+                workers = max_workers
+    return workers
+
+
 if __name__ == "__main__":
     uvicorn.run(
         "app.main:app",
         host=settings.uvicorn_host,
         port=settings.uvicorn_port,
         reload=settings.uvicorn_reload,
-        log_level=settings.uvicorn_log_level
+        log_level=settings.uvicorn_log_level,
+        loop=settings.uvicorn_loop,
+        http=settings.uvicorn_http,
+        workers=get_worker_count()
     )
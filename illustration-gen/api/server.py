@@ -8,7 +8,7 @@ import os
 import random
 import tempfile
 import traceback
-import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 import aiohttp
 import torch
@@ -44,6 +44,8 @@ class HttpClient:
 class TextToImagePipeline:
     pipeline: any = None
     device: str = None
+    # [negative, positive] CLIP embeddings of the static IP-Adapter reference
+    ip_adapter_image_embeds: torch.Tensor = None
 
     def start(self):
         if torch.cuda.is_available():
@@ -51,27 +53,28 @@ class TextToImagePipeline:
             model_path = os.getenv("MODEL_PATH", "stabilityai/stable-diffusion-xl-base-1.0")
             logger.info("Loading CUDA")
             self.device = "cuda"
+            # bf16 needs Ampere or newer; fall back to fp16 on older GPUs
+            dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
 
             # load pipeline
             if model_file != None:
                 logger.info("Loading model from single file")
                 self.pipeline = StableDiffusionXLPipeline.from_single_file(
                 model_file,
-                torch_dtype=torch.bfloat16,
+                torch_dtype=dtype,
             ).to(device=self.device)
             else:
                 logger.info("Loading model from model path")
                 self.pipeline = StableDiffusionXLPipeline.from_pretrained(
                     model_path,
-                    torch_dtype=torch.bfloat16,
+                    torch_dtype=dtype,
                 ).to(device=self.device)
 
             # (optional) attach adapters
-            enable_ip_adapter = os.getenv("ENABLE_IP_ADAPTER", "false")
             ip_adapter = os.getenv("IP_ADAPTER")
             ip_adapter_subfolder = os.getenv("IP_ADAPTER_SUBFOLDER")
             ip_adapter_weights = os.getenv("IP_ADAPTER_WEIGHTS")
-            if enable_ip_adapter == "true":
+            if ENABLE_IP_ADAPTER:
                 logger.info("Attaching IP-Adapter")
                 self.pipeline.load_ip_adapter(
                 ip_adapter,
@@ -79,6 +82,13 @@ class TextToImagePipeline:
                 weight_name=ip_adapter_weights
                 )
                 self.pipeline.set_ip_adapter_scale(float(os.getenv("IP_ADAPTER_SCALE", 0.33)))
+                # the reference never changes: load and encode it once here
+                # instead of running the image encoder on every request
+                logger.info("Encoding IP-Adapter reference image")
+                with torch.no_grad():
+                    self.ip_adapter_image_embeds = self.pipeline.prepare_ip_adapter_image_embeds(
+                        load_image(IP_ADAPTER_IMAGE), None, self.device, 1, True
+                    )[0]
 
             # (optional) attach LoRA weights
             enable_lora = os.getenv("ENABLE_LORA", "false")
@@ -90,6 +100,21 @@ class TextToImagePipeline:
                     lora_weights, weight_name=lora_weights_name
                 )
 
+            # convolutions run faster on NHWC tensors
+            self.pipeline.unet.to(memory_format=torch.channels_last)
+            self.pipeline.vae.to(memory_format=torch.channels_last)
+
+            # (optional) compile the UNet; adapters must be attached first
+            if os.getenv("ENABLE_COMPILE", "false") == "true":
+                compile_mode = os.getenv("COMPILE_MODE", "reduce-overhead")
+                logger.info(f"Compiling UNet (mode={compile_mode})")
+                self.pipeline.unet = torch.compile(self.pipeline.unet, mode=compile_mode, dynamic=False)
+                # compile (and record CUDA graphs) now rather than on the first request
+                # one shape per batch size the batcher can produce
+                for batch_size in range(1, MAX_BATCH_SIZE + 1):
+                    logger.info(f"Warming up compiled pipeline at batch size {batch_size}")
+                    inference(self.pipeline, ["warmup"] * batch_size, num_inference_steps=3)
+
         elif torch.backends.mps.is_available():
             logger.info("mps device, failing open")
             pass
@@ -101,39 +126,48 @@ def prompt_builder(content_prompt, style_prompt, age = -1):
         return f"{prompt}, age {age}, {style_prompt}"
     return f"{content_prompt}, {style_prompt}"
 
-def inference(pipeline, prompt, num_inference_steps):
-    # inference
-
-    prompt_style_experiments = [
-        "high contrast, minimalistic, colored black and grungy white, stark, graphic novel illustration, cross hatching",
-        "monochrome, bright highlights, deep shadows, graphic novel illustration",
-        "monochrome, journal entry sketch, graphic novel illustration",
-        "highest quality, monochrome, professional sketch, personal, intimate, nostalgic",
-        "highest quality, monochrome, professional sketch, personal, nostalgic, clean",
-        "highest quality, monochrome, professional sketch, personal, nostalgic, clean",
-        "highest quality, monochrome, professional sketch, clean, simple",
-        "highest quality, monochrome, professional sketch, clean, simple", # can't decide about adding "stylized"
-        "highest quality, professional sketch, monochrome", # can't decide about adding "stylized"
-    ]
-
-    negative_prompt_experiments = [
-        "worst quality, low quality, error, glitch, mistake, busy, words, writing, photo, photo-realistic",
-        "error, glitch, mistake",
-    ]
-    if os.getenv("ENABLE_IP_ADAPTER") == "true":
-        ip_adapter_image = load_image(os.getenv("IP_ADAPTER_IMAGE"))
-        return pipeline(
-            prompt = prompt_builder(prompt, prompt_style_experiments[5]),
-            negative_prompt=negative_prompt_experiments[1],
-            ip_adapter_image=ip_adapter_image,
-            num_inference_steps=num_inference_steps
-        ).images[0]
-    else:
-        return pipeline(
-            prompt = prompt_builder(prompt, prompt_style_experiments[5]),
-            negative_prompt=negative_prompt_experiments[1],
-            num_inference_steps=num_inference_steps
-        ).images[0]
+PROMPT_STYLE_EXPERIMENTS = (
+    "high contrast, minimalistic, colored black and grungy white, stark, graphic novel illustration, cross hatching",
+    "monochrome, bright highlights, deep shadows, graphic novel illustration",
+    "monochrome, journal entry sketch, graphic novel illustration",
+    "highest quality, monochrome, professional sketch, personal, intimate, nostalgic",
+    "highest quality, monochrome, professional sketch, personal, nostalgic, clean",
+    "highest quality, monochrome, professional sketch, personal, nostalgic, clean",
+    "highest quality, monochrome, professional sketch, clean, simple",
+    "highest quality, monochrome, professional sketch, clean, simple", # can't decide about adding "stylized"
+    "highest quality, professional sketch, monochrome", # can't decide about adding "stylized"
+)
+
+NEGATIVE_PROMPT_EXPERIMENTS = (
+    "worst quality, low quality, error, glitch, mistake, busy, words, writing, photo, photo-realistic",
+    "error, glitch, mistake",
+)
+
+# the experiments currently in use
+STYLE_PROMPT = PROMPT_STYLE_EXPERIMENTS[5]
+NEGATIVE_PROMPT = NEGATIVE_PROMPT_EXPERIMENTS[1]
+# fixed for every batch, so the per-prompt build is a single concat
+STYLE_SUFFIX = ", " + STYLE_PROMPT
+ENABLE_IP_ADAPTER = os.getenv("ENABLE_IP_ADAPTER") == "true"
+IP_ADAPTER_IMAGE = os.getenv("IP_ADAPTER_IMAGE")
+
+def inference(pipeline, prompts, num_inference_steps, generators=None):
+    # inference; one image per prompt
+    pipeline_kwargs = {}
+    if shared_pipeline.ip_adapter_image_embeds is not None:
+        # diffusers tiles the single reference across the prompts
+        pipeline_kwargs["ip_adapter_image_embeds"] = [shared_pipeline.ip_adapter_image_embeds]
+    return pipeline(
+        prompt=[prompt + STYLE_SUFFIX for prompt in prompts],
+        negative_prompt=[NEGATIVE_PROMPT] * len(prompts),
+        num_inference_steps=num_inference_steps,
+        generator=generators,
+        **pipeline_kwargs
+    ).images
+
+# requests arriving within BATCH_WINDOW_MS share one pipeline call
+MAX_BATCH_SIZE = max(1, int(os.getenv("MAX_BATCH_SIZE", 4)))
+BATCH_WINDOW = int(os.getenv("BATCH_WINDOW_MS", 50)) / 1000
 
 app = FastAPI()
 service_url = os.getenv("SERVICE_URL", "http://localhost:8000")
@@ -143,6 +177,12 @@ if not os.path.exists(image_dir):
 app.mount("/images", StaticFiles(directory=image_dir), name="images")
 http_client = HttpClient()
 shared_pipeline = TextToImagePipeline()
+# (prompt, generator, future) waiting for the batching loop
+inference_queue: asyncio.Queue = None
+# GPU work gets its own thread instead of sharing the default executor
+inference_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference")
+# PNG encoding and disk writes stay off the event loop and the GPU thread
+io_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="io")
 
 # Configure CORS settings
 app.add_middleware(
@@ -157,15 +197,47 @@ app.add_middleware(
 @app.on_event("startup")
 def startup():
     http_client.start()
-    shared_pipeline.start()
+    # load (and warm up) on the thread that will run inference: CUDA graphs
+    # recorded by reduce-overhead are only replayed on the recording thread
+    inference_executor.submit(shared_pipeline.start).result()
+    global inference_queue
+    inference_queue = asyncio.Queue()
+    asyncio.get_event_loop().create_task(run_batches())
+
+
+async def run_batches():
+    # the pipeline is not reentrant: batches run one at a time
+    loop = asyncio.get_event_loop()
+    while True:
+        batch = [await inference_queue.get()]
+        if MAX_BATCH_SIZE > 1:
+            await asyncio.sleep(BATCH_WINDOW)
+        while len(batch) < MAX_BATCH_SIZE and not inference_queue.empty():
+            batch.append(inference_queue.get_nowait())
+        prompts = [prompt for prompt, _, _ in batch]
+        generators = [generator for _, generator, _ in batch]
+        logger.info(f"Running batch of {len(batch)} request(s)")
+        try:
+            images = await loop.run_in_executor(
+                inference_executor,
+                lambda: inference(shared_pipeline.pipeline, prompts, num_inference_steps=50, generators=generators)
+            )
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for (_, _, future), image in zip(batch, images):
+                if not future.done():
+                    future.set_result(image)
 
 
 def save_image(image):
-    filename = "draw" + str(uuid.uuid4()).split("-")[0] + ".png"
+    filename = "draw" + os.urandom(4).hex() + ".png"
     image_path = os.path.join(image_dir, filename)
     # write image to disk at image_path
     logger.info(f"Saving image to {image_path}")
-    image.save(image_path)
+    image.save(image_path, compress_level=1)
     return os.path.join(service_url, "images", filename)
 
 
@@ -179,12 +251,14 @@ async def base():
 @app.post("/v1/images/generations")
 async def generate_image(image_input: GenerateIllustrationInput):
     try:
-        loop = asyncio.get_event_loop()
-        scheduler = shared_pipeline.pipeline.scheduler.from_config(shared_pipeline.pipeline.scheduler.config)
-        pipeline = StableDiffusionXLPipeline.from_pipe(shared_pipeline.pipeline, scheduler=scheduler)
-        output = await loop.run_in_executor(None, lambda: inference(pipeline, image_input.prompt, num_inference_steps = 50))
+        # reuse the loaded pipeline and scheduler; only the RNG is per request
+        generator = torch.Generator(device=shared_pipeline.device).manual_seed(random.randint(0, 2**32 - 1))
+        future = asyncio.get_event_loop().create_future()
+        await inference_queue.put((image_input.prompt, generator, future))
+        output = await future
         logger.info(f"output: {output}")
-        image_url = save_image(output.images[0])
+        # wait for the file so the returned URL can be fetched right away
+        image_url = await asyncio.get_event_loop().run_in_executor(io_executor, save_image, output)
         return {"data": [{"url": image_url}]}
     except Exception as e:
         if isinstance(e, HTTPException):